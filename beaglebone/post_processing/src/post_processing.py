@@ -2,61 +2,325 @@ import sys
 import os
 import io
 import math
-import struct
+import time
+import random
+import multiprocessing
+import collections
 import numpy
 import cv2
 
 from functools import reduce
 
-from pinto import PintoConfiguration, PintoMeta, PintoVideo, PintoDetect, PintoBlock, error, h_pixelate
-from jpeg import Bitstream
+from pinto import PintoConfiguration, PintoMeta, PintoVideo, PintoDetect, PintoGrid, PintoTrailer, error, parse_options, h_pixelate
 
 
 
-def detect(image, row, column, mode, unit=16):
+class HuffmanTable:
+
+	LOOKUP_BITS = 8
+
+	def __init__(self, code_count, value):
+		self.code = {}
+		self.match = {}
+		self.lookup = [ None ] * (1 << HuffmanTable.LOOKUP_BITS)
+		self.long = [ None ] * (1 << HuffmanTable.LOOKUP_BITS)
+
+		# codes of up to 8 bits resolve in the first level, longer codes in a second 8 bit level
+		code = index = 0
+		for depth in range(16):
+			length = depth + 1
+			for _ in range(code_count[depth]):
+				entry = (value[index], length)
+				self.code[value[index]] = (code, length)
+				self.match[(code, length)] = value[index]
+
+				if length <= HuffmanTable.LOOKUP_BITS:
+					start, count = code << (8 - length), 1 << (8 - length)
+					self.lookup[start:start + count] = [ entry ] * count
+				else:
+					prefix = code >> (length - 8)
+					if self.long[prefix] is None: self.long[prefix] = [ None ] * 256
+					start, count = (code << (16 - length)) & 0xFF, 1 << (16 - length)
+					self.long[prefix][start:start + count] = [ entry ] * count
+
+				index += 1
+				code += 1
+			code <<= 1
+
+	cache = {}
+
+	@staticmethod
+	def load(code_count, value):
+		key = (bytes(code_count), bytes(value))
+		if key not in HuffmanTable.cache: HuffmanTable.cache[key] = HuffmanTable(code_count, value)
+		return HuffmanTable.cache[key]
+
+
+class HuffmanReader:
+
+	def __init__(self, data):
+		self.data = bytes(data) + b'\x00\x00\x00\x00'
+		self.size = len(data) * 8
+		self.position = 0
+
+	def peek(self, length):
+		i, data = self.position >> 3, self.data
+		window = (data[i] << 16) | (data[i + 1] << 8) | data[i + 2]
+		return (window >> (24 - (self.position & 7) - length)) & ((1 << length) - 1)
+
+	def read(self, length):
+		value = self.peek(length)
+		self.position += length
+		return value
+
+	def decode(self, table):
+		bits = self.peek(16)
+		entry = table.lookup[bits >> 8]
+		if entry is None:
+			long = table.long[bits >> 8]
+			entry = None if long is None else long[bits & 0xFF]
+
+		# no code matches the remaining bits (padding at the end of the scan)
+		if entry is None or entry[1] > self.size - self.position: return None
+
+		self.position += entry[1]
+		return entry[0], bits >> (16 - entry[1]), entry[1]
+
+
+class BitReader(HuffmanReader):
+
+	# the decoder the lookup tables replaced, one bit at a time matched against every (code, length). only kept to benchmark against
+	def decode(self, table):
+		start, code = self.position, 0
+		for length in range(1, min(16, self.size - start) + 1):
+			code = (code << 1) | self.read(1)
+			if (code, length) in table.match: return table.match[(code, length)], code, length
+
+		self.position = start
+		return None
+
+
+class HuffmanWriter:
+
+	def __init__(self):
+		self.buffer = bytearray()
+		self.value = 0
+		self.count = 0
+
+	def write(self, value, length):
+		self.value = (self.value << length) | value
+		self.count += length
+
+		if self.count >= 8:
+			size, self.count = self.count >> 3, self.count & 7
+			self.buffer += (self.value >> self.count).to_bytes(size, byteorder='big')
+			self.value &= (1 << self.count) - 1
+
+	def copy(self, reader, start, end):
+		if end <= start: return
+
+		# bits [start, end) of the reader are appended as one span
+		i, j = start >> 3, (end + 7) >> 3
+		value = int.from_bytes(reader.data[i:j], byteorder='big') >> (j * 8 - end)
+		self.write(value & ((1 << (end - start)) - 1), end - start)
+
+	def result(self):
+		# the last byte is padded with 1 bits
+		if self.count == 0: return bytes(self.buffer)
+
+		padding = 8 - self.count
+		return bytes(self.buffer) + bytes([ (self.value << padding) | ((1 << padding) - 1) ])
+
+
+
+def transcode(data, components, detected, offset=0, decoder=HuffmanReader):
+	coefficient_lookup_table = lambda v, l: v if v >= 1 << l - 1 else v - (1 << l) + 1
+
+	DC, AC = 0, 1
+
+	reader = decoder(data)
+	writer = HuffmanWriter()
+
+	diff = { component['id']: 0 for component in components }
+
+	# bits of non-detected mcus are not written one symbol at a time, they are copied from start as one span
+	index, start = offset, 0
+	skip = pending = False
+
+	while True:
+		# detected is a bitmap indexed by mcu number, decided once per mcu
+		skip = index < len(detected) and detected[index] != 0
+		if skip: writer.copy(reader, start, reader.position)
+
+		for component in components:
+			symbol = reader.decode(component['table'][DC])
+			if symbol is None: break
+
+			# DC: (length:huff) (value:dc_table), the value only matters inside or right after a detected region
+			position = reader.position - symbol[2]
+			length = symbol[0]
+			if not skip and not pending:
+				reader.position += length
+				value = 0
+			else:
+				value = coefficient_lookup_table(reader.read(length), length) if length > 0 else 0
+
+			if skip:
+				writer.write(*component['itable'][DC][0])
+				diff[component['id']] += value
+			elif pending and diff[component['id']] != 0:
+				# first block after a detected region: re-encode the DC difference
+				writer.copy(reader, start, position)
+
+				value += diff[component['id']]
+				if value == 0:
+					writer.write(*component['itable'][DC][0])
+				else:
+					length = abs(value).bit_length()
+					writer.write(*component['itable'][DC][length])
+					writer.write(value if value > 0 else value - 1 + (1 << length), length)
+
+				diff[component['id']] = 0
+				start = reader.position
+
+			# AC: ((zeros, length):huff) (value:dc_table), only counted to find the end of the block
+			table = component['table'][AC]
+			k = 1
+			while k < 64:
+				symbol = reader.decode(table)
+				if symbol is None: break
+
+				if symbol[0] == 0:
+					k = 64
+				elif symbol[0] == 0xF0:
+					k += 16
+				else:
+					k += (symbol[0] >> 4) + 1
+					reader.position += symbol[0] & 0x0F
+			if k < 64: break
+
+			if skip: writer.write(*component['itable'][AC][0])
+		else:
+			index += 1
+			if skip: start = reader.position
+			pending = skip or (pending and any(diff.values()))
+			continue
+		break
+
+	if not skip: writer.copy(reader, start, reader.position)
+
+	return writer.result()
+
+class SegmentPool:
+
+	# the worker processes only start once a frame has more than one restart segment to spread over them
+	def __init__(self, processes=None):
+		self.processes = processes
+		self.pool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		if self.pool is not None: self.pool.terminate()
+
+	def starmap(self, function, arguments, chunksize=None):
+		if self.pool is None: self.pool = multiprocessing.Pool(self.processes)
+		return self.pool.starmap(function, arguments, chunksize)
+
+
+class Tracker:
+
+	def __init__(self, margin=0.2, search=0.5):
+		self.margin = margin
+		self.search = search
+
+		self.gray = None
+		self.areas = []
+
+	def update(self, image, areas):
+		self.gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+		self.areas = [ tuple(int(v) for v in area) for area in areas ]
+		return areas
+
+	def track(self, image):
+		gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+		height, width = gray.shape
+
+		tracked = []
+		for (x, y, w, h) in self.areas:
+			# look for the previous box content around its previous position
+			dx, dy = math.ceil(w * self.search), math.ceil(h * self.search)
+			sx, sy, ex, ey = max(0, x - dx), max(0, y - dy), min(width, x + w + dx), min(height, y + h + dy)
+
+			if ex - sx >= w and ey - sy >= h:
+				result = cv2.matchTemplate(gray[sy:ey, sx:ex], self.gray[y:y + h, x:x + w], cv2.TM_CCOEFF_NORMED)
+				x, y = cv2.minMaxLoc(result)[3]
+				x, y = sx + x, sy + y
+			tracked.append((x, y, w, h))
+
+		self.gray = gray
+		self.areas = tracked
+
+		# tracked boxes are grown by the margin on every side so the privacy coverage stays conservative
+		areas = []
+		for (x, y, w, h) in tracked:
+			mx, my = math.ceil(w * self.margin), math.ceil(h * self.margin)
+			sx, sy = max(0, x - mx), max(0, y - my)
+			areas.append((sx, sy, min(width, x + w + mx) - sx, min(height, y + h + my) - sy))
+		return areas
+
+
+
+def detect(image, row, column, detector, tracker=None, statistics=None, unit=16):
 	pinto_blocks = []
 
-	areas = []
-	for m in PintoDetect.modes[mode.lower()]:
-		areas += m[0](image, m[1])
+	start = time.perf_counter()
+
+	# cascades run on keyframes, the frames in between reuse or track their boxes
+	keyframe = detector.frame % detector.interval == 0
+	areas = detector.detect(image)
+	if tracker is not None: areas = tracker.update(image, areas) if keyframe else tracker.track(image)
+
+	if statistics is not None:
+		key = 'keyframe' if keyframe else 'tracked'
+		elapsed = time.perf_counter() - start
+		statistics[key] += 1
+		statistics[key + ' time'] += elapsed
+		statistics['max time'] = max(statistics['max time'], elapsed)
 
 	width, height = image.shape[1::-1]
 
 	row = 1 if row < 1 else math.ceil(height / unit) if row > math.ceil(height / unit) else row
 	column = 1 if column < 1 else math.ceil(width / unit) if column > math.ceil(width / unit) else column
 
-	jrow = math.ceil(height / unit)
-	jcolumn = math.ceil(width / unit)
-
-	s = set()
-	for (x, y, w, h) in areas:
-		sci = PintoBlock.index(x // unit, jcolumn, column)
-		sri = PintoBlock.index(y // unit, jrow, row)
-		eci = PintoBlock.index((x + w - 1) // unit, jcolumn, column) + 1
-		eri = PintoBlock.index((y + h - 1) // unit, jrow, row) + 1
-		xv, yv = numpy.meshgrid(numpy.arange(sci, eci), numpy.arange(sri * column, eri * column, column))
-		s.update((xv + yv).flatten().tolist())
-
-	for index in list(s):
-		ri, ci = index // column, index % column
-		sx = PintoBlock.position(ci, column, width, unit)
-		ex = PintoBlock.position(ci + 1, column, width, unit)
-		sy = PintoBlock.position(ri, row, height, unit)
-		ey = PintoBlock.position(ri + 1, row, height, unit)
-		pinto_blocks.append({ 'index': index, 'data': image[sy:ey, sx:ex].copy() })
+	grid = PintoGrid.load(width, height, row, column, unit)
+
+	for index in numpy.flatnonzero(grid.mask(areas)).tolist():
+		pinto_blocks.append({ 'index': index, 'data': image[grid.slices[index]].copy() })
 
 	return pinto_blocks
 
-def lossless_encode(image):
-	success, encoded = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 9])
-	return None if not success else encoded.tostring()
+def lossless_encode(image, codec='png', level=None):
+	return PintoTrailer.encode(image, codec, level)
 
-def modify(jpeg, pinto_blocks, row, column, unit=16):
+def encode(pinto_blocks, previous, keyframe, codec='png', level=None):
+	# pixelated pinto blocks are encoded whole on keyframes and where the previous frame has no block at their index, as deltas otherwise
+	current = {}
+	for pinto_block in pinto_blocks:
+		pixelated = current[pinto_block['index']] = pinto_block['pixelated']
+		reference = previous.get(pinto_block['index'])
+
+		pinto_block['delta'] = not keyframe and reference is not None and reference.shape == pixelated.shape
+		pinto_block['encoded data'] = lossless_encode(PintoTrailer.delta(pixelated, reference) if pinto_block['delta'] else pixelated, codec, level)
+
+	# the pixelated blocks by index, the reference of the next frame
+	return current
+
+def modify(jpeg, pinto_blocks, row, column, unit=16, pool=None, checksum=False, codec='png', decoder=HuffmanReader):
 	byte2int = lambda bytes: int.from_bytes(bytes, byteorder='big')
 	nibble = lambda byte: (byte >> 4, byte & 0x0F)
 
-	coefficient_lookup_table = lambda v, l: v if v >= 1 << l - 1 else v - (1 << l) + 1
-
 	DC, AC = 0, 1
 	LUMINANCE, CHROMINANCE = 0, 1
 	Y = LUMINANCE
@@ -134,14 +398,7 @@ def modify(jpeg, pinto_blocks, row, column, unit=16):
 					if total > 256: error('total code count > 256')
 
 					ht['value'] = [ v for v in reader.read(total) ]
-					ht['table'] = {}
-					code = index = 0
-					for depth in range(16):
-						for _ in range(ht['code count'][depth]):
-							ht['table'][(code, depth + 1)] = ht['value'][index]
-							index += 1
-							code += 1
-						code <<= 1
+					ht['table'] = HuffmanTable.load(ht['code count'], ht['value'])
 					size -= 17 + total
 
 					jd['DHT']['data'][ht['id']][ht['type']] = ht
@@ -161,47 +418,48 @@ def modify(jpeg, pinto_blocks, row, column, unit=16):
 
 				reader.read(3) # skip 3 bytes
 
-				jd['DATA'] = { 'offset': reader.tell(), 'data': b'' }
+				jd['DATA'] = { 'offset': reader.tell(), 'data': [] }
+
+				# entropy coded data runs up to the first marker that is neither stuffing nor RSTn
+				start = end = reader.tell()
+				while True:
+					end = jpeg.find(b'\xFF', end)
+					if end < 0 or end + 1 >= len(jpeg): error('cannot find end of scan')
 
-			elif b == 0x00:
-				if 'DATA' in jd:
-					jd['DATA']['data'] += bytes([0xFF])
+					if jpeg[end + 1] == 0x00:
+						end += 2
+					elif 0xD0 <= jpeg[end + 1] <= 0xD7:
+						jd['DATA']['data'].append(jpeg[start:end].replace(b'\xFF\x00', b'\xFF'))
+						start = end = end + 2
+					else:
+						jd['DATA']['data'].append(jpeg[start:end].replace(b'\xFF\x00', b'\xFF'))
+						break
+
+				reader.seek(end)
+
+			elif b == 0xDD:
+				jd['DRI'] = { 'offset': reader.tell()-2, 'data': {} }
+				# print('DRI')
+				size = byte2int(reader.read(2))
+
+				jd['DRI']['data']['interval'] = byte2int(reader.read(2))
 
 			elif b == 0xD9:
 				jd['EOI'] = { 'offset': reader.tell()-2 }
 				# print('EOI')
 
 			else:
-				error('not expected marker: {0:X}'.format(read))
-		else:
-			if 'DATA' in jd: jd['DATA']['data'] += bytes([b])
+				error('not expected marker: {0:X}'.format(b))
 
 
 	# decode image data
 	width, height = jd['SOF']['data']['width'], jd['SOF']['data']['height']
 
-	jrow = math.ceil(height / unit)
-	jcolumn = math.ceil(width / unit)
+	grid = PintoGrid.load(width, height, row, column, unit)
 
-	jb_index = lambda pb_i, pb_n, px_n, jb_u: math.floor(pb_i * px_n / pb_n / jb_u)
-
-	s = set()
-	for pinto_block in pinto_blocks:
-		index = pinto_block['index']
-		ri, ci = index // column, index % column
-		sci = jb_index(ci, column, width, unit)
-		eci = jb_index(ci + 1, column, width, unit)
-		sri = jb_index(ri, row, height, unit)
-		eri = jb_index(ri + 1, row, height, unit)
-		xv, yv = numpy.meshgrid(numpy.arange(sci, eci), numpy.arange(sri * jcolumn, eri * jcolumn, jcolumn))
-		s.update((xv + yv).flatten().tolist())
-	detected = list(s)
-
-	bs_reader = Bitstream(jd['DATA']['data'])
-	bs_writer = Bitstream()
-	mcus = []
-	mcu = []
-	du = []
+	mask = numpy.zeros(len(grid), dtype=bool)
+	mask[[ pinto_block['index'] for pinto_block in pinto_blocks ]] = True
+	detected = grid.mcu_mask(mask).tobytes()
 
 	sof_components = jd['SOF']['data']['components']
 	sos_components = jd['SOS']['data']['components']
@@ -212,132 +470,243 @@ def modify(jpeg, pinto_blocks, row, column, unit=16):
 
 		component = {}
 		component['table'] = { t: jd['DHT']['data'][sc['huffman table id'][t]][t]['table'] for t in (DC, AC) }
-		component['itable'] = { t: { v: k for k, v in component['table'][t].items() } for t in (DC, AC) }
+		component['itable'] = { t: component['table'][t].code for t in (DC, AC) }
 		component['id'] = sc['component id']
 
 		for _ in range(fc['sampling factors']['vertical'] * fc['sampling factors']['horizontal']):
 			components.append(component)
 
-	diff = { k: 0 for k in COMPONENT_ID }
+	# every restart interval starts with fresh DC predictions, so the segments are rewritten independently
+	segments = jd['DATA']['data']
+	interval = jd['DRI']['data']['interval'] if 'DRI' in jd else 0
+	arguments = [ (segment, components, detected, i * interval, decoder) for i, segment in enumerate(segments) ]
 
-	c = 0
-	d = 0
+	if pool is None or len(segments) == 1:
+		scans = [ transcode(*argument) for argument in arguments ]
+	else:
+		scans = pool.starmap(transcode, arguments, chunksize=math.ceil(len(segments) / (4 * os.cpu_count())))
 
-	while True:
-		try:
-			bit = bs_reader.read()
-		except: break
+	markers = [ bytes([0xFF, 0xD0 + i % 8]) for i in range(len(scans) - 1) ] + [ b'' ]
+	scan = b''.join(x.replace(b'\xFF', b'\xFF\x00') + marker for x, marker in zip(scans, markers))
 
-		c = (c << 1) | bit
-		d += 1
 
-		if len(du) == 0:
-			ht = components[len(mcu)]['table'][DC]
+	trailer = PintoTrailer([ pinto_block['index'] for pinto_block in pinto_blocks ], [ pinto_block['encoded data'] for pinto_block in pinto_blocks ], codec=codec, checksum=checksum, deltas=[ pinto_block.get('delta', False) for pinto_block in pinto_blocks ])
 
-			if (c, d) in ht:
-				# DC: (length:huff) (value:dc_table)
-				length = ht[(c, d)]
+	modified_jpeg = jpeg[:jd['DATA']['offset']] + scan + jpeg[jd['EOI']['offset']:]
+	return modified_jpeg + PintoTrailer.pack(trailer)
 
-				if length == 0:
-					value = 0
-				else:
-					temp = bs_reader.read(length)
-					value = coefficient_lookup_table(temp, length)
+def batch(iterable, size):
+	frames = []
+	for frame in iterable:
+		frames.append(frame)
+		if len(frames) == size:
+			yield frames
+			frames = []
+	if frames: yield frames
 
-				if len(mcus) in detected:
-					bs_writer.write(*components[len(mcu)]['itable'][DC][0])
-					diff[components[len(mcu)]['id']] += value
-				else:
-					if diff[components[len(mcu)]['id']] == 0:
-						bs_writer.write(c, d)
-						if length > 0: bs_writer.write(temp, length)
-					else:
-						new_value = value + diff[components[len(mcu)]['id']]
-						if new_value == 0:
-							bs_writer.write(*components[len(mcu)]['itable'][DC][0])
-						else:
-							length = int(math.log(abs(new_value), 2)) + 1
-							value = new_value if new_value > 0 else new_value - 1 + (1 << length)
-							bs_writer.write(*components[len(mcu)]['itable'][DC][length])
-							bs_writer.write(value, length)
-						diff[components[len(mcu)]['id']] = 0
-
-				du.append(value if len(mcus) == 0 else value + mcus[-1][len(mcu)][0])
-
-				d = c = 0
-		elif len(du) < 64:
-			ht = components[len(mcu)]['table'][AC]
-
-			if (c, d) in ht:
-				# AC: ((zeros, length):huff) (value:dc_table)
-				if len(mcus) not in detected: bs_writer.write(c, d)
-
-				temp = ht[(c, d)]
-
-				if temp == 0:
-					du += [0] * (64 - len(du))
-				elif temp == 0xF0:
-					du += [0] * 16
-				else:
-					zeros, length = temp >> 4, temp & 0x0F
+def process(jpegs, row, column, intensity, mode, scale=None, interval=None, track=None, pixelate_hash='sha256', checksum=False, codec='png', level=None, delta=0, pool=None):
+	# every batch starts on a keyframe, so the detector and tracker state never crosses a batch
+	detector = PintoDetect(mode, scale=scale, interval=interval)
+	tracker = None if track is None else Tracker(margin=track)
 
-					temp = bs_reader.read(length)
-					if len(mcus) not in detected: bs_writer.write(temp, length)
+	statistics = { 'keyframe': 0, 'keyframe time': 0.0, 'tracked': 0, 'tracked time': 0.0, 'max time': 0.0 }
+	pixelated_jpegs = []
 
-					value = coefficient_lookup_table(temp, length)
-					du += [0] * zeros
-					du.append(value)
+	# with deltas, blocks are stored whole every delta frames from the start of every batch, so a batch never needs another
+	previous = {}
+	for n, jpeg in enumerate(jpegs):
+		# jpeg -(decode)-> image
+		image = cv2.imdecode(numpy.frombuffer(jpeg, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
 
-				d = c = 0
-		if len(du) >= 64:
-			if len(mcus) in detected: bs_writer.write(*components[len(mcu)]['itable'][AC][0])
+		# image -(detect)-> pinto blocks
+		pinto_blocks = detect(image, row, column, detector, tracker, statistics)
 
-			mcu.append(du)
-			du = []
+		# pinto block -(h pixelate)-(delta)-(lossless encode)-> encoded pinto block
+		for pinto_block in pinto_blocks: pinto_block['pixelated'] = h_pixelate(pinto_block['data'], intensity, pixelate_hash)
+		previous = encode(pinto_blocks, previous, delta == 0 or n % delta == 0, codec, level)
 
-		if len(mcu) == len(components):
-			mcus.append(mcu)
-			mcu = []
+		# jpeg + pinto blocks -(erase)-(wrap)-> pixelated jpeg
+		pixelated_jpegs.append(modify(jpeg, pinto_blocks, row, column, pool=pool, checksum=checksum, codec=codec) if len(pinto_blocks) > 0 else jpeg)
 
+	return pixelated_jpegs, statistics
 
-	pinto_block = { 'indices': b'', 'encoded data': b'' }
-	for pinto_block in pinto_blocks:
-		pinto_block['indices'] += struct.pack('>H', pblock['index'])
-		pinto_block['encoded data'] += struct.pack('>I', len(pblock['encoded data'])) + pblock['encoded data']
-	pinto_block_data = struct.pack('>H', len(pinto_block['indices'])) + pinto_block['indices'] + pinto_block['encoded data']
+def report(statistics):
+	frames = statistics['keyframe'] + statistics['tracked']
+	elapsed = statistics['keyframe time'] + statistics['tracked time']
+	if frames == 0: return
 
-	modified_jpeg = jpeg[:jd['DATA']['offset']] + bs_writer.result().replace(b'\xFF', b'\xFF\x00') + jpeg[jd['EOI']['offset']:]
-	return modified_jpeg + pinto_block_data
+	average = lambda key: 1000 * statistics[key + ' time'] / statistics[key] if statistics[key] > 0 else 0
 
-def pixelate(pv_name, ppv_name, mode):
+	print('detect: {frames} frames, {keyframes} keyframes ({rate:.1f}% detected by cascades), {fps:.2f} fps'.format(frames=frames, keyframes=statistics['keyframe'], rate=100 * statistics['keyframe'] / frames, fps=frames / elapsed if elapsed > 0 else 0))
+	print('detect: {average:.2f} ms/frame, {keyframe:.2f} ms/keyframe, {tracked:.2f} ms/tracked frame, {max:.2f} ms max'.format(average=1000 * elapsed / frames, keyframe=average('keyframe'), tracked=average('tracked'), max=1000 * statistics['max time']))
+
+def pixelate(pv_name, ppv_name, mode, workers=1, scale=None, interval=None, track=None, checksum=False, codec='png', level=None, delta=0):
 	pm = PintoMeta.load(PintoConfiguration.pm_path(pv_name))
+
+	options = { 'scale': scale, 'interval': interval, 'track': track, 'pixelate_hash': pm.pixelate_hash, 'checksum': checksum, 'codec': codec, 'level': level, 'delta': delta }
+	size = PintoDetect(mode, scale=scale, interval=interval).interval
+
+	# a batch only grows when one delta run would not fit, to the shortest multiple of the detector interval that holds it
+	if delta > size: size *= math.ceil(delta / size)
+
+	# the keyframes go to the .pm, verification starts its ranges on them
+	pm.delta, pm.batch = delta, size if delta > 0 else 0
 	PintoMeta.save(PintoConfiguration.pm_path(ppv_name), pm)
 
+	statistics = collections.Counter()
+	def write(result):
+		pixelated_jpegs, batch_statistics = result
+
+		# the pixelated video is indexed with the record times of the source frames, not the time it was written
+		for pixelated_jpeg in pixelated_jpegs: ppv.write(pixelated_jpeg, pv.time(ppv.frames))
+
+		longest = max(statistics['max time'], batch_statistics['max time'])
+		statistics.update(batch_statistics)
+		statistics['max time'] = longest
+
 	with PintoVideo(PintoConfiguration.pv_path(pv_name), 'rb') as pv:
 		with PintoVideo(PintoConfiguration.pv_path(ppv_name), 'wb') as ppv:
-			for jpeg in pv:
+			if workers > 1:
+				# batches of frames are spread over the pool and written back in order, at most 2 * workers in flight
+				with multiprocessing.Pool(workers) as pool:
+					window = collections.deque()
+					for jpegs in batch(pv, size):
+						window.append(pool.apply_async(process, (jpegs, pm.row, pm.column, pm.intensity, mode), options))
+						if len(window) >= 2 * workers: write(window.popleft().get())
+
+					while window: write(window.popleft().get())
+			else:
+				# restart segments of one frame are rewritten across the pool
+				with SegmentPool() as pool:
+					for jpegs in batch(pv, size):
+						write(process(jpegs, pm.row, pm.column, pm.intensity, mode, pool=pool, **options))
+
+	report(statistics)
 
-				# jpeg -(decode)-> image
-				image = cv2.imdecode(numpy.fromstring(jpeg, dtype=numpy.int8), cv2.IMREAD_UNCHANGED)
+def benchmark(pv_name, mode):
+	pm = PintoMeta.load(PintoConfiguration.pm_path(pv_name))
+	detector = PintoDetect(mode)
 
-				# image -(detect)-> pinto blocks
-				pinto_blocks = detect(image, pm.row, pm.column, mode)
+	# the bit by bit decoder before the lookup tables and the current one, on the same frames and blocks
+	decoders = [ ('bit by bit', BitReader), ('lookup table', HuffmanReader) ]
 
-				# pinto block -(h pixelate)-(lossless encode)-> encoded pinto block
+	frames, elapsed, identical = 0, { name: 0.0 for name, _ in decoders }, True
+	with SegmentPool() as pool:
+		with PintoVideo(PintoConfiguration.pv_path(pv_name), 'rb') as pv:
+			for jpeg in pv:
+				image = cv2.imdecode(numpy.frombuffer(jpeg, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
+
+				pinto_blocks = detect(image, pm.row, pm.column, detector)
 				for pinto_block in pinto_blocks:
-					pinto_block['encoded data'] = lossless_encode(h_pixelate(pinto_block['data'], pm.intensity))
+					pinto_block['encoded data'] = lossless_encode(h_pixelate(pinto_block['data'], pm.intensity, pm.pixelate_hash))
 
-				# jpeg + pinto blocks -(erase)-(wrap)-> pixelated jpeg
-				pixelated_jpeg = modify(jpeg, pinto_blocks, pm.row, pm.column) if len(pinto_blocks) > 0 else jpeg
+				# only the scan rewrite is measured
+				results = []
+				for name, decoder in decoders:
+					start = time.perf_counter()
+					results.append(modify(jpeg, pinto_blocks, pm.row, pm.column, pool=pool, decoder=decoder))
+					elapsed[name] += time.perf_counter() - start
 
-				ppv.write(pixelated_jpeg)
+				identical = identical and results[0] == results[1]
+				frames += 1
 
+	for name, _ in decoders:
+		print('modify ({name}): {frames} frames in {elapsed:.3f}s, {fps:.2f} fps'.format(name=name, frames=frames, elapsed=elapsed[name], fps=frames / elapsed[name] if elapsed[name] > 0 else 0))
 
+	before, after = (elapsed[name] for name, _ in decoders)
+	print('lookup table is {speedup:.2f}x the bit by bit decoder, the rewritten frames are {result}'.format(speedup=before / after if after > 0 else 0, result='identical' if identical else 'different'))
 
-if __name__ == '__main__':
-	if len(sys.argv) == 4:
-		pv_name, pixelated_pv_name, mode = sys.argv[1:]
+def benchmark_coverage(pv_name, coverages=(0, 10, 50)):
+	pm = PintoMeta.load(PintoConfiguration.pm_path(pv_name))
 
-		pixelate(pv_name, pixelated_pv_name, mode)
+	for coverage in coverages:
+		# the same pseudo random blocks are selected for every run
+		selector = random.Random(0)
+		count = round(pm.row * pm.column * coverage / 100)
+
+		frames, elapsed = 0, 0.0
+		with PintoVideo(PintoConfiguration.pv_path(pv_name), 'rb') as pv:
+			for jpeg in pv:
+				pinto_blocks = [ { 'index': i, 'encoded data': b'' } for i in sorted(selector.sample(range(pm.row * pm.column), count)) ]
+
+				start = time.perf_counter()
+				modify(jpeg, pinto_blocks, pm.row, pm.column)
+				elapsed += time.perf_counter() - start
+				frames += 1
+
+		print('modify ({coverage}% detected): {frames} frames in {elapsed:.3f}s, {fps:.2f} fps'.format(coverage=coverage, frames=frames, elapsed=elapsed, fps=frames / elapsed if elapsed > 0 else 0))
+
+def benchmark_codec(pv_name, mode, delta=30, settings=None):
+	pm = PintoMeta.load(PintoConfiguration.pm_path(pv_name))
+	detector = PintoDetect(mode)
+
+	# the h pixelated blocks that would be embedded for real, frame by frame so deltas have their previous frame
+	frames = []
+	with PintoVideo(PintoConfiguration.pv_path(pv_name), 'rb') as pv:
+		for jpeg in pv:
+			image = cv2.imdecode(numpy.frombuffer(jpeg, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
+			frames.append([ { 'index': pinto_block['index'], 'pixelated': h_pixelate(pinto_block['data'], pm.intensity, pm.pixelate_hash) } for pinto_block in detect(image, pm.row, pm.column, detector) ])
+
+	count = sum(len(pinto_blocks) for pinto_blocks in frames)
+	if count == 0: error('no pinto blocks detected')
+	original = sum(pinto_block['pixelated'].nbytes for pinto_blocks in frames for pinto_block in pinto_blocks)
+
+	settings = settings or [ ('png', 9), ('png', 3), ('png', 1), ('webp', None), ('raw', None), ('zlib', 1), ('zlib', 6), ('zstd', 3), ('lz4', None) ]
+	print('{count} blocks in {frames} frames, {size} bytes'.format(count=count, frames=len(frames), size=original))
+	print('{codec:>16} {encode:>12} {decode:>12} {size:>10} {ratio:>7}'.format(codec='codec', encode='encode ms', decode='decode ms', size='bytes', ratio='ratio'))
+
+	for codec, level in settings:
+		if codec not in PintoTrailer.available: continue
+
+		for interval in [ 0, delta ]:
+			start = time.perf_counter()
+			previous = {}
+			for n, pinto_blocks in enumerate(frames):
+				previous = encode(pinto_blocks, previous, interval == 0 or n % interval == 0, codec, level)
+			encoded = time.perf_counter() - start
+
+			# decoded the way verification does, deltas on top of the previous frame's blocks
+			start = time.perf_counter()
+			previous, identical = {}, True
+			for pinto_blocks in frames:
+				current = {}
+				for pinto_block in pinto_blocks:
+					block = PintoTrailer.decode(pinto_block['encoded data'], codec)
+					current[pinto_block['index']] = PintoTrailer.restore(block, previous[pinto_block['index']]) if pinto_block['delta'] else block
+				identical = identical and all(numpy.array_equal(current[pinto_block['index']], pinto_block['pixelated']) for pinto_block in pinto_blocks)
+				previous = current
+			decoded = time.perf_counter() - start
+
+			if not identical: error('{codec} is not lossless'.format(codec=codec))
+
+			size = sum(len(pinto_block['encoded data']) for pinto_blocks in frames for pinto_block in pinto_blocks)
+			name = (codec if level is None else '{codec}:{level}'.format(codec=codec, level=level)) + (' delta {interval}'.format(interval=interval) if interval else '')
+			print('{codec:>16} {encode:12.3f} {decode:12.3f} {size:10} {ratio:7.3f}'.format(codec=name, encode=1000 * encoded, decode=1000 * decoded, size=size, ratio=size / original))
+
+
+if __name__ == '__main__':
+	if len(sys.argv) in [5, 6] and sys.argv[1] == 'benchmark' and sys.argv[4] == 'codec':
+		benchmark_codec(*sys.argv[2:4], *map(int, sys.argv[5:]))
+	elif len(sys.argv) == 4 and sys.argv[1] == 'benchmark' and sys.argv[3] == 'coverage':
+		benchmark_coverage(sys.argv[2])
+	elif len(sys.argv) == 4 and sys.argv[1] == 'benchmark':
+		pv_name, mode = sys.argv[2:]
+
+		benchmark(pv_name, mode)
+	elif len(sys.argv) >= 4:
+		pv_name, pixelated_pv_name, mode = sys.argv[1:4]
+		options = parse_options(sys.argv[4:], [ '--workers', '--scale', '--interval', '--track', '--checksum', '--codec', '--level', '--delta' ])
+
+		scale, interval, track = options.get('--scale'), options.get('--interval'), options.get('--track')
+		codec, level = options.get('--codec', 'png'), options.get('--level')
+		if codec not in PintoTrailer.available: error('unavailable codec: {codec}'.format(codec=codec))
+		if level is not None and not PintoTrailer.valid_level(codec, int(level)): error('invalid level for {codec}: {level}'.format(codec=codec, level=level))
+
+		delta = int(options.get('--delta', 0))
+		if delta < 0: error('delta has to be 0 (off) or a keyframe interval: {delta}'.format(delta=delta))
+
+		pixelate(pv_name, pixelated_pv_name, mode, workers=int(options.get('--workers', 1)), scale=scale and float(scale), interval=interval and int(interval), track=track and float(track), checksum=options.get('--checksum') == 'on', codec=codec, level=level and int(level), delta=delta)
 	else:
-		print('python3 {file} (name) (pixelated name) (none | lp | face | all)'.format(file=sys.argv[0]))
\ No newline at end of file
+		print('python3 {file} (name) (pixelated name) (none | lp | face | all) [--workers (count)] [--scale (factor)] [--interval (frames)] [--track (margin)] [--checksum (on | off)] [--codec ({codecs})] [--level (level)] [--delta (keyframe interval)]'.format(file=sys.argv[0], codecs=' | '.join(PintoTrailer.available)))
+		print('python3 {file} benchmark (name) (none | lp | face | all | coverage)'.format(file=sys.argv[0]))
+		print('python3 {file} benchmark (name) (lp | face | all) codec [(delta)]'.format(file=sys.argv[0]))
\ No newline at end of file
@@ -1,61 +1,96 @@
 import sys
 import os
+import bisect
+import math
 import datetime
+import time
 import struct
+import mmap
+import socket
+import socketserver
+import threading
 import hashlib
+import hmac
+import zlib
 import numpy
 import cv2
 
+from queue import Queue, Empty, Full
+
+try:
+	import blake3
+except ImportError:
+	blake3 = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+try:
+	import lz4.frame
+except ImportError:
+	lz4 = None
+
 
 
 time2str = lambda t: datetime.datetime.fromtimestamp(t).strftime("%Y%m%d_%H%M%S")
 
 
 pixelate_mask = numpy.tile(numpy.array([0b11000000, 0b11100000, 0b11100000], dtype=numpy.uint8), (1, 10)).reshape((10, 3))
-pixelate_value = numpy.zeros((10, 3), dtype=numpy.uint8)
-
-def h_pixelate(block, intensity):
-	global pixelate_mask, pixelate_value
-	digest = int.from_bytes(hashlib.sha256(block.copy(order='C')).digest(), byteorder='big')
-	pixelated = cv2.resize(block, (max(10, block.shape[1] // intensity), max(1, block.shape[0] // intensity)), interpolation=cv2.INTER_NEAREST)
-	pixelate_value[0, 0] = (digest >> 0) 	& 0b00111111
-	pixelate_value[0, 1] = (digest >> 6) 	& 0b00011111
-	pixelate_value[0, 2] = (digest >> 11) 	& 0b00011111
-	pixelate_value[1, 0] = (digest >> 16) 	& 0b00111111
-	pixelate_value[1, 1] = (digest >> 22) 	& 0b00011111
-	pixelate_value[1, 2] = (digest >> 27) 	& 0b00011111
-	pixelate_value[2, 0] = (digest >> 32) 	& 0b00111111
-	pixelate_value[2, 1] = (digest >> 38) 	& 0b00011111
-	pixelate_value[2, 2] = (digest >> 43) 	& 0b00011111
-	pixelate_value[3, 0] = (digest >> 48) 	& 0b00111111
-	pixelate_value[3, 1] = (digest >> 54) 	& 0b00011111
-	pixelate_value[3, 2] = (digest >> 59) 	& 0b00011111
-	pixelate_value[4, 0] = (digest >> 64) 	& 0b00111111
-	pixelate_value[4, 1] = (digest >> 70) 	& 0b00011111
-	pixelate_value[4, 2] = (digest >> 75) 	& 0b00011111
-	pixelate_value[5, 0] = (digest >> 80) 	& 0b00111111
-	pixelate_value[5, 1] = (digest >> 86) 	& 0b00011111
-	pixelate_value[5, 2] = (digest >> 91) 	& 0b00011111
-	pixelate_value[6, 0] = (digest >> 96) 	& 0b00111111
-	pixelate_value[6, 1] = (digest >> 102) 	& 0b00011111
-	pixelate_value[6, 2] = (digest >> 107) 	& 0b00011111
-	pixelate_value[7, 0] = (digest >> 112) 	& 0b00111111
-	pixelate_value[7, 1] = (digest >> 118) 	& 0b00011111
-	pixelate_value[7, 2] = (digest >> 123) 	& 0b00011111
-	pixelate_value[8, 0] = (digest >> 128) 	& 0b00111111
-	pixelate_value[8, 1] = (digest >> 134) 	& 0b00011111
-	pixelate_value[8, 2] = (digest >> 139) 	& 0b00011111
-	pixelate_value[9, 0] = (digest >> 144) 	& 0b00111111
-	pixelate_value[9, 1] = (digest >> 150) 	& 0b00011111
-	pixelate_value[9, 2] = (digest >> 155) 	& 0b00011111
-	nb[0, :10, :] = (nb[0, :10, :] & pixelate_mask) | pixelate_value
-	return nb
+pixelate_size = lambda width, height, intensity: (max(10, int(width // intensity)), max(1, int(height // intensity)))
+
+def pixelate_value(digests):
+	# bits 16k to 16k+15 of a big endian digest are the little endian words of the reversed digest
+	words = numpy.ascontiguousarray(digests[:, :-21:-1]).view('<u2')
+	return numpy.stack([ words & 0b00111111, (words >> 6) & 0b00011111, (words >> 11) & 0b00011111 ], axis=-1).astype(numpy.uint8)
+
+def h_pixelate(block, intensity, algorithm='sha256'):
+	# no shared scratch state: the value is built per call and pixelate_mask is only read, so threads can call it at once
+	digest = PintoHash.new(algorithm, numpy.ascontiguousarray(block)).digest()
+	pixelated = cv2.resize(block, pixelate_size(block.shape[1], block.shape[0], intensity), interpolation=cv2.INTER_NEAREST)
+	pixelated[0, :10, :] = (pixelated[0, :10, :] & pixelate_mask) | pixelate_value(numpy.frombuffer(digest, dtype=numpy.uint8).reshape(1, -1))[0]
+	return pixelated
+
+def h_pixelate_frame(frame, grid, intensity, indices=None, algorithm='sha256'):
+	selected = None
+	if indices is not None:
+		selected = numpy.zeros(len(grid), dtype=bool)
+		selected[list(indices)] = True
+
+	pixelated = [ None ] * len(grid)
+	for group in grid.pixelation(intensity):
+		i = numpy.arange(len(group['indices'])) if selected is None else numpy.flatnonzero(selected[group['indices']])
+		if len(i) == 0: continue
+
+		y, x, py, px = group['y'][i], group['x'][i], group['py'][i], group['px'][i]
+
+		# the blocks of a group, each contiguous, and their nearest neighbour samples, gathered at once
+		blocks = frame[y[:, :, None], x[:, None, :]]
+		samples = frame[py[:, :, None], px[:, None, :]]
+
+		digests = numpy.frombuffer(b''.join(PintoHash.new(algorithm, block).digest() for block in blocks), dtype=numpy.uint8).reshape(len(blocks), -1)
+		samples[:, 0, :10, :] = (samples[:, 0, :10, :] & pixelate_mask) | pixelate_value(digests)
+
+		for k, j in enumerate(group['indices'][i].tolist()): pixelated[j] = samples[k]
+
+	return pixelated
 
 
 def error(message):
 	print('error: {message}'.format(message=message))
 	exit(1)
 
+def parse_options(arguments, known):
+	# (option) (value) pairs, a mistyped option is an error rather than a silent default
+	if len(arguments) % 2 == 1: error('option without value: {option}'.format(option=arguments[-1]))
+
+	options = dict(zip(arguments[::2], arguments[1::2]))
+	for option in options:
+		if option not in known: error('unknown option: {option} (expected {known})'.format(option=option, known=', '.join(known)))
+
+	return options
+
 
 class AbstractVideoRecorder(threading.Thread):
 
@@ -70,6 +105,9 @@ class AbstractVideoRecorder(threading.Thread):
 		
 
 	def run(self):
+		# only the recording device has the camera module
+		import picamera
+
 		with picamera.PiCamera() as camera:
 			camera.resolution = self.resolution
 			camera.framerate = self.framerate
@@ -109,59 +147,412 @@ class AbstractVideoRecorder(threading.Thread):
 
 
 class PintoDetect:
-	face = lambda frame, cascade: list(cascade.detectMultiScale(frame, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30), flags=cv2.CASCADE_SCALE_IMAGE))
-	license_plate = lambda frame, cascade: list(cascade.detectMultiScale(frame, scaleFactor=1.3, minNeighbors=5, minSize=(60, 10), flags=cv2.CASCADE_DO_CANNY_PRUNING))
+	face = lambda frame, cascade, scale: list(cascade.detectMultiScale(frame, scaleFactor=1.1, minNeighbors=5, minSize=(round(30 / scale), round(30 / scale)), flags=cv2.CASCADE_SCALE_IMAGE))
+	license_plate = lambda frame, cascade, scale: list(cascade.detectMultiScale(frame, scaleFactor=1.3, minNeighbors=5, minSize=(round(60 / scale), round(10 / scale)), flags=cv2.CASCADE_DO_CANNY_PRUNING))
 
-	cascades = [ cv2.CascadeClassifier(x) for x in [ 'xml/face.xml', 'xml/eu.xml', 'xml/kr.xml' ] ]
+	path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xml')
+	files = [ 'face.xml', 'eu.xml', 'kr.xml' ]
 	functions = [ face, license_plate, license_plate ]
 	modes = {
 		'none': [],
-		'lp': [ (functions[x], cascades[x]) for x in (1, 2) ],
-		'face': [ (functions[x], cascades[x]) for x in (0, ) ],
-		'all': [ (functions[x], cascades[x]) for x in (0, 1, 2) ]
+		'lp': [ 1, 2 ],
+		'face': [ 0 ],
+		'all': [ 0, 1, 2 ]
+	}
+
+	# scale: each cascade runs on the frame shrunk by this factor, interval: cascades run on every n-th frame only
+	options = {
+		'none': { 'scale': [], 'interval': 1 },
+		'lp': { 'scale': [ 1, 1 ], 'interval': 1 },
+		'face': { 'scale': [ 1 ], 'interval': 1 },
+		'all': { 'scale': [ 1, 1, 1 ], 'interval': 1 }
 	}
 
+	cascades = {}
+
+	def __init__(self, mode, scale=None, interval=None):
+		self.mode = mode.lower()
+		if self.mode not in PintoDetect.modes: error('unknown detection mode: {mode}'.format(mode=mode))
+		if scale is not None and not scale > 0: error('scale has to be positive: {scale}'.format(scale=scale))
+
+		options = PintoDetect.options[self.mode]
+		scales = options['scale'] if scale is None else [ scale ] * len(PintoDetect.modes[self.mode])
+
+		self.detectors = [ (PintoDetect.functions[i], PintoDetect.cascade(i), s) for i, s in zip(PintoDetect.modes[self.mode], scales) ]
+		self.interval = max(1, int(options['interval'] if interval is None else interval))
+
+		self.frame = 0
+		self.areas = []
+
+	def __repr__(self):
+		return 'Pinto Detect: {mode} (scale={scale}, interval={interval})'.format(mode=self.mode, scale=[ d[2] for d in self.detectors ], interval=self.interval)
+
+
+	def detect(self, image):
+		# boxes of the last keyframe are reused in between
+		if self.frame % self.interval == 0: self.areas = self.run(image)
+		self.frame += 1
+		return self.areas
+
+	def run(self, image):
+		if len(self.detectors) == 0: return []
+
+		height, width = image.shape[:2]
+		pyramid = PintoDetect.pyramid(image, [ d[2] for d in self.detectors ])
+
+		areas = []
+		for function, cascade, scale in self.detectors:
+			for (x, y, w, h) in function(pyramid[scale], cascade, scale):
+				# map the box corners back to full resolution, rounding outwards
+				x1, y1 = int(x * scale), int(y * scale)
+				x2, y2 = min(math.ceil((x + w) * scale), width), min(math.ceil((y + h) * scale), height)
+				if x2 > x1 and y2 > y1: areas.append((x1, y1, x2 - x1, y2 - y1))
+
+		return areas
+
+
+	@staticmethod
+	def cascade(i):
+		if i not in PintoDetect.cascades:
+			PintoDetect.cascades[i] = cv2.CascadeClassifier(os.path.join(PintoDetect.path, PintoDetect.files[i]))
+		return PintoDetect.cascades[i]
+
+	@staticmethod
+	def pyramid(image, scales):
+		# one grayscale conversion per frame, one resize per distinct scale, shared by every cascade
+		gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+		height, width = gray.shape
+
+		levels = {}
+		for scale in set(scales):
+			levels[scale] = gray if scale == 1 else cv2.resize(gray, (max(1, round(width / scale)), max(1, round(height / scale))), interpolation=cv2.INTER_AREA)
+		return levels
+
 
 class PintoBlock:
 	position = lambda pb_i, pb_n, px_n, jb_u: math.floor(pb_i * px_n / pb_n / jb_u) * jb_u
 	index = lambda jb_i, jb_n, pb_n: abs(pb_n - 1 - (jb_n - 1 - (jb_i % jb_n) + (jb_i // jb_n) * jb_n) * pb_n // jb_n)
 
 
+class PintoGrid:
+
+	def __init__(self, width, height, row, column, unit=16):
+		self.width, self.height = width, height
+		self.row, self.column = row, column
+		self.unit = unit
+
+		self.jrow, self.jcolumn = math.ceil(height / unit), math.ceil(width / unit)
+
+		# pixel boundaries of the block rows and columns
+		self.x = numpy.array([ PintoBlock.position(c, column, width, unit) for c in range(column + 1) ])
+		self.y = numpy.array([ PintoBlock.position(r, row, height, unit) for r in range(row + 1) ])
+
+		# block index -> (x1, y1, x2, y2) and the matching slices, in row-major block order
+		x1, y1 = numpy.meshgrid(self.x[:-1], self.y[:-1])
+		x2, y2 = numpy.meshgrid(self.x[1:], self.y[1:])
+		self.rectangles = numpy.stack([ x1.ravel(), y1.ravel(), x2.ravel(), y2.ravel() ], axis=1)
+		self.slices = [ (slice(y1, y2), slice(x1, x2)) for x1, y1, x2, y2 in self.rectangles.tolist() ]
+
+		# jpeg mcu index -> block index, -1 for the mcus past the last block boundary
+		ri = numpy.searchsorted(self.y // unit, numpy.arange(self.jrow), side='right') - 1
+		ci = numpy.searchsorted(self.x // unit, numpy.arange(self.jcolumn), side='right') - 1
+		inside = (ri < row)[:, None] & (ci < column)[None, :]
+		self.mcu_block = numpy.where(inside, ri[:, None] * column + ci[None, :], -1).ravel()
+
+		# jpeg block index -> block row and column, as used for detected areas
+		self.jrow_block = PintoBlock.index(numpy.arange(self.jrow), self.jrow, row)
+		self.jcolumn_block = PintoBlock.index(numpy.arange(self.jcolumn), self.jcolumn, column)
+
+		# intensity -> blocks grouped by size, with their pixel and nearest neighbour coordinates
+		self.pixelations = {}
+
+	def __repr__(self):
+		return 'Pinto Grid: {width}x{height} {row}x{column} ({unit})'.format(width=self.width, height=self.height, row=self.row, column=self.column, unit=self.unit)
+
+	def __len__(self):
+		return self.row * self.column
+
+
+	def mask(self, areas):
+		mask = numpy.zeros((self.row, self.column), dtype=bool)
+		if len(areas) == 0: return mask
+
+		x, y, w, h = numpy.array(areas, dtype=numpy.int64).reshape(-1, 4).T
+		sci = self.jcolumn_block[numpy.clip(x // self.unit, 0, self.jcolumn - 1)]
+		sri = self.jrow_block[numpy.clip(y // self.unit, 0, self.jrow - 1)]
+		eci = self.jcolumn_block[numpy.clip((x + w - 1) // self.unit, 0, self.jcolumn - 1)] + 1
+		eri = self.jrow_block[numpy.clip((y + h - 1) // self.unit, 0, self.jrow - 1)] + 1
+
+		valid = (sci < eci) & (sri < eri)
+		sci, sri, eci, eri = sci[valid], sri[valid], eci[valid], eri[valid]
+
+		# every area adds +1 inside its block rectangle: mark the corners and integrate along both axes
+		count = numpy.zeros((self.row + 1, self.column + 1), dtype=numpy.int32)
+		numpy.add.at(count, (sri, sci), 1)
+		numpy.add.at(count, (sri, eci), -1)
+		numpy.add.at(count, (eri, sci), -1)
+		numpy.add.at(count, (eri, eci), 1)
+
+		return count.cumsum(axis=0).cumsum(axis=1)[:self.row, :self.column] > 0
+
+	def mcu_mask(self, mask):
+		return numpy.asarray(mask).ravel()[self.mcu_block] & (self.mcu_block >= 0)
+
+	def pixelation(self, intensity):
+		if intensity in self.pixelations: return self.pixelations[intensity]
+
+		groups = []
+		sizes = self.rectangles[:, 2:] - self.rectangles[:, :2]
+		for width, height in numpy.unique(sizes, axis=0).tolist():
+			indices = numpy.flatnonzero((sizes[:, 0] == width) & (sizes[:, 1] == height))
+			x1, y1 = self.rectangles[indices, 0], self.rectangles[indices, 1]
+
+			# the nearest neighbour map of a size is whatever cv2.resize picks from an image of indices
+			pw, ph = pixelate_size(width, height, intensity)
+			xs = cv2.resize(numpy.arange(width, dtype=numpy.int32).reshape(1, width), (pw, 1), interpolation=cv2.INTER_NEAREST)[0]
+			ys = cv2.resize(numpy.arange(height, dtype=numpy.int32).reshape(height, 1), (1, ph), interpolation=cv2.INTER_NEAREST)[:, 0]
+
+			groups.append({
+				'indices': indices,
+				'x': x1[:, None] + numpy.arange(width), 'y': y1[:, None] + numpy.arange(height),
+				'px': x1[:, None] + xs, 'py': y1[:, None] + ys
+			})
+
+		self.pixelations[intensity] = groups
+		return groups
+
+
+	grids = {}
+
+	@staticmethod
+	def load(width, height, row, column, unit=16):
+		key = (width, height, row, column, unit)
+		if key not in PintoGrid.grids: PintoGrid.grids[key] = PintoGrid(*key)
+		return PintoGrid.grids[key]
+
+
+class PintoTrailer:
+
+	# header: magic, version, flags, codec, block count. then one table entry per block, then the encoded blocks back to back
+	magic = b'PNTB'
+	version = 1
+	header = struct.Struct('>4sBBBH')
+
+	checksum_flag = 0b00000001
+	delta_flag = 0b00000010
+
+	# codec ids are stored in the header, new codecs only ever go to the end
+	codecs = [ 'png', 'webp', 'raw', 'zlib', 'zstd', 'lz4' ]
+	available = [ c for c in codecs if (c != 'zstd' or zstandard) and (c != 'lz4' or lz4) ]
+
+	# default, lowest and highest compression level per codec, webp and raw have none
+	levels = { 'png': (9, 0, 9), 'zlib': (6, 0, 9), 'zstd': (3, 1, 22), 'lz4': (0, 0, 16) }
+	valid_level = lambda codec, level: level is None or (codec in PintoTrailer.levels and PintoTrailer.levels[codec][1] <= level <= PintoTrailer.levels[codec][2])
+
+	# raw: height, width, channels, then the pixels as they are
+	shape = struct.Struct('>HHB')
+
+	# entry: block index, end of its data after the table, crc32 of its data with the checksum flag, whether it is a delta with the delta flag
+	entry = lambda checksum, delta: numpy.dtype([ ('index', '>u2'), ('end', '>u4') ] + ([ ('crc', '>u4') ] if checksum else []) + ([ ('delta', 'u1') ] if delta else []))
+
+	# a delta is taken against the same block of the previous frame, it wraps around so the block always comes back exactly
+	delta = lambda block, reference: block - reference
+	restore = lambda delta, reference: delta + reference
+
+	def __init__(self, indices=None, data=None, codec='png', checksum=False, deltas=None):
+		if codec not in PintoTrailer.codecs: raise Exception('unknown codec: {codec}'.format(codec=codec))
+
+		self.indices = indices or []
+		self.data = data or []
+		self.codec = codec
+		self.checksum = checksum
+		self.deltas = deltas or [ False ] * len(self.indices)
+
+	def __repr__(self):
+		return 'Pinto Trailer: {count} blocks ({codec})'.format(count=len(self), codec=self.codec)
+
+	def __len__(self):
+		return len(self.indices)
+
+
+	@staticmethod
+	def pack(trailer):
+		# frames without deltas keep the short table
+		delta = any(trailer.deltas)
+
+		table = numpy.zeros(len(trailer), dtype=PintoTrailer.entry(trailer.checksum, delta))
+		table['index'] = trailer.indices
+		table['end'] = numpy.cumsum([ len(data) for data in trailer.data ])
+		if trailer.checksum: table['crc'] = [ zlib.crc32(data) for data in trailer.data ]
+		if delta: table['delta'] = trailer.deltas
+
+		flags = (PintoTrailer.checksum_flag if trailer.checksum else 0) | (PintoTrailer.delta_flag if delta else 0)
+		header = PintoTrailer.header.pack(PintoTrailer.magic, PintoTrailer.version, flags, PintoTrailer.codecs.index(trailer.codec), len(trailer))
+
+		return b''.join([ header, table.tobytes() ] + trailer.data)
+
+	@staticmethod
+	def unpack(data):
+		data = memoryview(data)
+		if len(data) == 0: return PintoTrailer()
+		if bytes(data[:4]) != PintoTrailer.magic: return PintoTrailer.unpack_legacy(data)
+
+		magic, version, flags, codec, count = PintoTrailer.header.unpack_from(data)
+		if version != PintoTrailer.version: raise Exception('unknown trailer version: {version}'.format(version=version))
+		if codec >= len(PintoTrailer.codecs): raise Exception('unknown codec id: {codec}'.format(codec=codec))
+		if flags & ~(PintoTrailer.checksum_flag | PintoTrailer.delta_flag): raise Exception('unknown trailer flags: {flags}'.format(flags=flags))
+
+		# the whole table is read at once, the blocks are views into the trailer
+		checksum, delta = flags & PintoTrailer.checksum_flag != 0, flags & PintoTrailer.delta_flag != 0
+		table = numpy.frombuffer(data, dtype=PintoTrailer.entry(checksum, delta), count=count, offset=PintoTrailer.header.size)
+
+		base = PintoTrailer.header.size + table.nbytes
+		ends = table['end'].astype(numpy.int64) + base
+		starts = numpy.concatenate([ [ base ], ends[:-1] ])
+		if count > 0 and ends[-1] > len(data): raise Exception('trailer is truncated')
+
+		blocks = [ data[start:end] for start, end in zip(starts.tolist(), ends.tolist()) ]
+		if checksum:
+			for index, block, crc in zip(table['index'].tolist(), blocks, table['crc'].tolist()):
+				if zlib.crc32(block) != crc: raise Exception('pinto block {index} fails its checksum'.format(index=index))
+
+		return PintoTrailer(table['index'].tolist(), blocks, PintoTrailer.codecs[codec], checksum, (table['delta'] != 0).tolist() if delta else None)
+
+	@staticmethod
+	def unpack_legacy(data):
+		# byte length of the indices, the indices, then length prefixed pngs
+		size = struct.unpack_from('>H', data)[0]
+		indices = numpy.frombuffer(data, dtype='>u2', count=size // 2, offset=2).tolist()
+
+		blocks, position = [], 2 + size
+		while position < len(data):
+			length = struct.unpack_from('>I', data, position)[0]
+			blocks.append(data[position + 4:position + 4 + length])
+			position += 4 + length
+
+		if len(indices) != len(blocks): raise Exception('count and number of encoded data is not same')
+
+		return PintoTrailer(indices, blocks)
+
+	@staticmethod
+	def encode(image, codec='png', level=None):
+		if codec not in PintoTrailer.available: raise Exception('unavailable codec: {codec}'.format(codec=codec))
+		if not PintoTrailer.valid_level(codec, level): raise Exception('invalid level for {codec}: {level}'.format(codec=codec, level=level))
+		if level is None and codec in PintoTrailer.levels: level = PintoTrailer.levels[codec][0]
+
+		if codec in [ 'png', 'webp' ]:
+			# above 100 webp is lossless
+			success, encoded = cv2.imencode('.' + codec, image, [ cv2.IMWRITE_PNG_COMPRESSION, level ] if codec == 'png' else [ cv2.IMWRITE_WEBP_QUALITY, 101 ])
+			if not success: raise Exception('cannot encode pinto block ({codec})'.format(codec=codec))
+			return encoded.tobytes()
+
+		height, width = image.shape[:2]
+		raw = PintoTrailer.shape.pack(height, width, 1 if image.ndim == 2 else image.shape[2]) + numpy.ascontiguousarray(image).tobytes()
+
+		if codec == 'zlib': return zlib.compress(raw, level)
+		if codec == 'zstd': return zstandard.ZstdCompressor(level=level).compress(raw)
+		if codec == 'lz4': return lz4.frame.compress(raw, compression_level=level)
+		return raw
+
+	@staticmethod
+	def decode(data, codec='png'):
+		if codec not in PintoTrailer.available: raise Exception('unavailable codec: {codec}'.format(codec=codec))
+
+		if codec in [ 'png', 'webp' ]:
+			image = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
+			if image is None: raise Exception('cannot decode pinto block ({codec})'.format(codec=codec))
+			return image
+
+		if codec == 'zlib': data = zlib.decompress(data)
+		if codec == 'zstd': data = zstandard.ZstdDecompressor().decompress(data)
+		if codec == 'lz4': data = lz4.frame.decompress(data)
+
+		height, width, channels = PintoTrailer.shape.unpack_from(data)
+		image = numpy.frombuffer(data, dtype=numpy.uint8, offset=PintoTrailer.shape.size).reshape(height, width, channels)
+		return image[:, :, 0] if channels == 1 else image
+
+
 class PintoHash:
 
-	def __init__(self, digest=None, time=None, sign=None):
-		self.hash = hashlib.new('sha1')
+	modes = [ 'chain', 'merkle' ]
+
+	# h pixelate uses the low 160 bits of a digest, every algorithm here has at least that
+	algorithms = [ a for a in [ 'sha1', 'sha256', 'sha512', 'sha3_256', 'blake2b', 'blake2s' ] if a in hashlib.algorithms_available ] + ([ 'blake3' ] if blake3 else [])
+
+	def __init__(self, digest=None, time=None, sign=None, mode='chain', segment=30, nodes=None, algorithm='sha1', batch_root='', proof=None, checkpoint=0, checkpoints=None, fingerprint=0, fingerprints=None):
+		if mode not in PintoHash.modes: raise Exception('unknown hash mode: {mode}'.format(mode=mode))
+
+		self.hash = PintoHash.new(algorithm)
 		self.digest = digest
 		self.time = time
 		self.sign = sign
+		self.algorithm = algorithm
+
+		# merkle: block digests are leaves of a frame node, frame nodes of a segment node, segment nodes of the root
+		self.mode = mode
+		self.segment = int(segment)
+		self.nodes = nodes or []
+		self.leaves = 0
+		self.frame_hash = PintoHash.new(self.algorithm, b'\x01')
+
+		# batched timestamps sign the root of several digests, the proof leads from this digest to it
+		self.batch_root = batch_root
+		self.proof = proof or []
+
+		# chain: the running digest every checkpoint frames. fingerprint: leading bytes of every block digest per frame
+		self.checkpoint = int(checkpoint)
+		self.checkpoints = checkpoints or []
+		self.fingerprint = int(fingerprint)
+		self.fingerprints = fingerprints or []
+		self.frames = 0
+		self.blocks = []
 
 	def __repr__(self):
-		return str(self.__dict__)
+		return str({ k: v for k, v in self.__dict__.items() if k not in ['hash', 'frame_hash', 'nodes', 'checkpoints', 'fingerprints', 'blocks'] })
 
 
 	def update(self, data):
-		self.hash.update(data)
-		self.digest = self.hash.hexdigest()
-		
+		if self.fingerprint > 0: self.blocks.append(data[:self.fingerprint].hex())
+
+		if self.mode == 'merkle':
+			self.frame_hash.update(data)
+			self.leaves += 1
+		else:
+			self.hash.update(data)
+			self.digest = self.hash.hexdigest()
+
+	def frame(self):
+		self.frames += 1
+
+		if self.fingerprint > 0:
+			self.fingerprints.append(''.join(self.blocks))
+			self.blocks = []
+
+		if self.mode == 'merkle':
+			self.nodes.append(self.frame_hash.hexdigest())
+			self.leaves = 0
+			self.frame_hash = PintoHash.new(self.algorithm, b'\x01')
+		elif self.checkpoint > 0 and self.frames % self.checkpoint == 0:
+			self.checkpoints.append(self.hash.hexdigest())
 
-	def timestamp(self):
-		self.digest = self.hash.hexdigest()
+	def root(self):
+		segments = [ PintoHash.node(b'\x02', self.nodes[i:i + self.segment], self.algorithm) for i in range(0, len(self.nodes), self.segment) ]
+		return PintoHash.node(b'\x03', segments, self.algorithm)
 
-		# connect timestamp server
-		client = socket.socket()
-		client.connect(('127.0.0.1', 9999))
 
-		# send digest to timestamp server
-		client.send(self.digest)
+	def finish(self):
+		if self.mode == 'merkle':
+			if self.leaves > 0: self.frame()
+			self.digest = self.root()
+		else:
+			self.digest = self.hash.hexdigest()
 
-		# receive time, sign from timestamp server
-		self.time = client.read(10)
-		self.time = time2str(time.time())
-		self.sign = client.read(32)
-		self.sign = ''
+	def timestamp(self, address=('127.0.0.1', 9999)):
+		self.finish()
 
-		# disconnect
-		client.close()
+		# one request on its own connection, PintoTimestamp keeps one open for many
+		with socket.create_connection(address) as client:
+			self.time, self.sign = PintoTimestamp.request(client, [ self.digest ])[0]
 
 
 	@staticmethod
@@ -176,27 +567,245 @@ class PintoHash:
 				key, value = line.strip().split('=')
 				data[key] = value
 
-		order = { 'digest': str, 'time': str, 'sign': str }
+		# hashes saved before merkle mode have no mode line
+		if 'mode' not in data: data['mode'] = 'chain'
+		if 'segment' not in data: data['segment'] = 30
+		if 'algorithm' not in data: data['algorithm'] = 'sha1'
+		if 'batch_root' not in data: data['batch_root'] = ''
+		if 'checkpoint' not in data: data['checkpoint'] = 0
+		if 'fingerprint' not in data: data['fingerprint'] = 0
+		for key in [ 'nodes', 'proof', 'checkpoints', 'fingerprints' ]:
+			data[key] = data[key].split(',') if data.get(key) else []
+
+		order = { 'digest': str, 'time': str, 'sign': str, 'mode': str, 'segment': int, 'nodes': list, 'algorithm': str, 'batch_root': str, 'proof': list, 'checkpoint': int, 'checkpoints': list, 'fingerprint': int, 'fingerprints': list }
 		arguments = [ v(data[k]) for k, v in order.items() ]
 
 		return PintoHash(*arguments)
 
 	@staticmethod
-	def save(name, hash):
-		with open('{name}.ph'.format(name=name), 'w') as ph:
+	def save(name, hash, timestamp=None):
+		# with a PintoTimestamp client the hash is written once its stamp comes back, without waiting for it here
+		if timestamp is None:
 			hash.timestamp()
-			data = [ '{key}={value}'.format(key=k, value=v) for k, v in hash.__dict__.items() if k in ['digest', 'time', 'sign'] ]
+			PintoHash.write(name, hash)
+		elif not timestamp.submit(hash, lambda hash: PintoHash.write(name, hash)):
+			print('timestamp: queue is full, {name}.ph is saved without a timestamp'.format(name=name))
+			hash.finish()
+			hash.time, hash.sign = '', ''
+			PintoHash.write(name, hash)
+
+	@staticmethod
+	def write(name, hash):
+		with open('{name}.ph'.format(name=name), 'w') as ph:
+			data = [ '{key}={value}'.format(key=k, value=v) for k, v in hash.__dict__.items() if k in ['digest', 'time', 'sign', 'mode', 'algorithm'] ]
+			if hash.mode == 'merkle':
+				data.append('segment={segment}'.format(segment=hash.segment))
+				data.append('nodes={nodes}'.format(nodes=','.join(hash.nodes)))
+			if hash.batch_root:
+				data.append('batch_root={root}'.format(root=hash.batch_root))
+				data.append('proof={proof}'.format(proof=','.join(hash.proof)))
+			if hash.checkpoint > 0 and hash.mode == 'chain':
+				data.append('checkpoint={checkpoint}'.format(checkpoint=hash.checkpoint))
+				data.append('checkpoints={checkpoints}'.format(checkpoints=','.join(hash.checkpoints)))
+			if hash.fingerprint > 0:
+				data.append('fingerprint={fingerprint}'.format(fingerprint=hash.fingerprint))
+				data.append('fingerprints={fingerprints}'.format(fingerprints=','.join(hash.fingerprints)))
 			ph.write('\n'.join(data))
 
+	@staticmethod
+	def node(prefix, children, algorithm='sha1'):
+		return PintoHash.new(algorithm, prefix + b''.join(bytes.fromhex(c) for c in children)).hexdigest()
+
+	@staticmethod
+	def new(algorithm, data=b''):
+		if algorithm not in PintoHash.algorithms: raise Exception('unknown hash algorithm: {algorithm}'.format(algorithm=algorithm))
+		return blake3.blake3(data) if algorithm == 'blake3' else hashlib.new(algorithm, data)
+
+
+class PintoTimestamp(threading.Thread):
+
+	# request: count, then length prefixed hex digests. response: per digest 10 digit unix time and 32 byte sign
+	stamp_size = 10 + 32
+
+	# batch tree: leaves and inner nodes are told apart by their prefix, an odd node moves up as it is
+	leaf = lambda digest: hashlib.sha256(b'\x00' + bytes.fromhex(digest)).digest()
+	pair = lambda left, right: hashlib.sha256(b'\x01' + left + right).digest()
+
+	def __init__(self, address=('127.0.0.1', 9999), size=64, batch=16, retries=3, timeout=5.0, aggregate=False, linger=0.0):
+		super().__init__(daemon=True)
+
+		self.address = address
+		self.batch = batch
+		self.retries = retries
+		self.timeout = timeout
+
+		# aggregate: one stamp per batch on the root of its digests, linger: seconds to wait for a batch to fill
+		self.aggregate = aggregate
+		self.linger = linger
+
+		# hashes waiting for a stamp, submit never waits on a full queue
+		self.queue = Queue(size)
+		self.client = None
+
+		self.start()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, trackback):
+		self.close()
+
+
+	def submit(self, hash, callback):
+		hash.finish()
+
+		try:
+			self.queue.put_nowait((hash, callback))
+			return True
+		except Full:
+			return False
+
+	def run(self):
+		stop = False
+		while not stop:
+			item = self.queue.get()
+			if item is None: break
+
+			# everything queued meanwhile goes out in the same round trip
+			items = [ item ]
+			deadline = time.monotonic() + self.linger
+			while len(items) < self.batch:
+				try:
+					item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+				except Empty:
+					break
+
+				if item is None:
+					stop = True
+					break
+				items.append(item)
+
+			self.stamp(items)
+
+		if self.client is not None: self.client.close()
+
+	def stamp(self, items):
+		digests = [ hash.digest for hash, _ in items ]
+		if self.aggregate: root, proofs = PintoTimestamp.tree(digests)
+
+		stamps = None
+		for attempt in range(self.retries + 1):
+			try:
+				if self.client is None: self.client = socket.create_connection(self.address, timeout=self.timeout)
+				stamps = PintoTimestamp.request(self.client, [ root ] if self.aggregate else digests)
+				break
+			except Exception as e:
+				# a malformed reply leaves the connection out of step, it is dropped like a failed one
+				print('timestamp: {error} ({attempt}/{retries})'.format(error=e, attempt=attempt + 1, retries=self.retries + 1))
+				if self.client is not None: self.client.close()
+				self.client = None
+				if attempt < self.retries: time.sleep(0.1 * (1 << attempt))
+
+		if self.aggregate and stamps: stamps = stamps * len(items)
+
+		# the hashes are written either way, unstamped ones with an empty time and sign
+		for i, ((hash, callback), (stamp_time, sign)) in enumerate(zip(items, stamps or [ ('', '') ] * len(items))):
+			hash.time, hash.sign = stamp_time, sign
+			if self.aggregate and stamps: hash.batch_root, hash.proof = root, proofs[i]
+
+			try:
+				callback(hash)
+			except Exception as e:
+				print('timestamp: {error}'.format(error=e))
+
+	def close(self):
+		self.queue.put(None)
+		self.join()
+
+
+	@staticmethod
+	def request(client, digests):
+		client.sendall(struct.pack('>H', len(digests)) + b''.join(struct.pack('>B', len(d)) + d.encode() for d in digests))
+
+		response = PintoTimestamp.receive(client, PintoTimestamp.stamp_size * len(digests))
+		return [ (response[i:i + 10].decode(), response[i + 10:i + PintoTimestamp.stamp_size].hex()) for i in range(0, len(response), PintoTimestamp.stamp_size) ]
+
+	@staticmethod
+	def tree(digests):
+		level = [ PintoTimestamp.leaf(d) for d in digests ]
+		proofs = [ [] for _ in digests ]
+
+		# position of every leaf's ancestor in the current level, its sibling goes into the proof with its side
+		positions = list(range(len(digests)))
+		while len(level) > 1:
+			for i, position in enumerate(positions):
+				sibling = position ^ 1
+				if sibling < len(level): proofs[i].append(('L' if sibling < position else 'R') + level[sibling].hex())
+
+			level = [ PintoTimestamp.pair(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2) ]
+			positions = [ position // 2 for position in positions ]
+
+		return level[0].hex(), proofs
+
+	@staticmethod
+	def prove(digest, proof):
+		node = PintoTimestamp.leaf(digest)
+		for step in proof:
+			sibling = bytes.fromhex(step[1:])
+			node = PintoTimestamp.pair(sibling, node) if step[0] == 'L' else PintoTimestamp.pair(node, sibling)
+		return node.hex()
+
+	@staticmethod
+	def receive(client, size):
+		data = bytearray()
+		while len(data) < size:
+			chunk = client.recv(size - len(data))
+			if not chunk: raise ConnectionError('timestamp server closed the connection')
+			data += chunk
+		return bytes(data)
+
+	@staticmethod
+	def serve(port=9999, key=b'pinto'):
+		# stand in timestamp server: signs digest and time with an hmac, for testing without the real one
+		class Handler(socketserver.BaseRequestHandler):
+			def handle(self):
+				while True:
+					try:
+						count = struct.unpack('>H', PintoTimestamp.receive(self.request, 2))[0]
+					except ConnectionError:
+						break
+
+					stamps = []
+					for _ in range(count):
+						digest = PintoTimestamp.receive(self.request, PintoTimestamp.receive(self.request, 1)[0])
+						stamp_time = '{time:010d}'.format(time=int(time.time())).encode()
+						stamps.append(stamp_time + hmac.new(key, digest + stamp_time, hashlib.sha256).digest())
+
+					self.request.sendall(b''.join(stamps))
+
+		socketserver.ThreadingTCPServer.allow_reuse_address = True
+		with socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler) as server:
+			server.serve_forever()
+
 
 class PintoMeta:
-	
-	def __init__(self, video_time, row, column, intensity, frame_count):
+
+	# a pinto video with deltas stores every block whole on the keyframes, every delta frames from the start of every batch
+	keyframe = lambda self, frame: self.delta == 0 or frame % self.batch % self.delta == 0
+
+	def __init__(self, video_time, row, column, intensity, frame_count, pixelate_hash='sha256', dropped=None, delta=0, batch=0):
 		self.video_time = int(video_time)
 		self.row = int(row)
 		self.column = int(column)
 		self.intensity = float(intensity)
 		self.frame_count = int(frame_count)
+		self.pixelate_hash = pixelate_hash
+
+		# frames the recorder could not keep up with: (frame it would have been, record time), they are in neither the video nor the hash
+		self.dropped = dropped or []
+
+		self.delta = int(delta)
+		self.batch = int(batch)
 
 	def __repr__(self):
 		return str(self.__dict__)
@@ -215,8 +824,13 @@ class PintoMeta:
 				data[key] = value
 
 		if 'scale' in data: data['intensity'] = data['scale']
+		if 'pixelate_hash' not in data: data['pixelate_hash'] = 'sha256'
+		if 'dropped' not in data: data['dropped'] = ''
+		if 'delta' not in data: data['delta'], data['batch'] = 0, 0
 
-		order = { 'video_time': int, 'row': int, 'column': int, 'intensity': float, 'frame_count': int }
+		dropped = lambda value: [ (int(frame), float(time)) for frame, time in (d.split(':') for d in value.split(',') if d) ]
+
+		order = { 'video_time': int, 'row': int, 'column': int, 'intensity': float, 'frame_count': int, 'pixelate_hash': str, 'dropped': dropped, 'delta': int, 'batch': int }
 		arguments = [ v(data[k]) for k, v in order.items() ]
 
 		return PintoMeta(*arguments)
@@ -224,16 +838,51 @@ class PintoMeta:
 	@staticmethod
 	def save(name, meta):
 		with open('{name}.pm'.format(name=name), 'w') as pm:
-			data = [ '{key}={value}'.format(key=k, value=v) for k, v in meta.__dict__.items() ]
+			values = dict(meta.__dict__, dropped=','.join('{frame}:{time:.6f}'.format(frame=frame, time=time) for frame, time in meta.dropped))
+			data = [ '{key}={value}'.format(key=k, value=v) for k, v in values.items() ]
 			pm.write('\n'.join(data))
 
 
 class PintoVideo:
 
-	def __init__(self, name, mode):
+	def __init__(self, name, mode, memory_map=False, buffer_size=1 << 20, sync='close'):
 		self.name = name
 		self.mode = mode
-		self.file = open('{name}.pv'.format(name=self.name), self.mode)
+		self.file = open('{name}.pv'.format(name=self.name), self.mode, buffering=0 if self.mode == 'wb' else -1)
+
+		# read only mapping of the whole video: frames are returned as memoryviews into it, nothing is copied
+		self.map = None
+		self.view = None
+		self.cursor = 0
+
+		if memory_map:
+			if self.mode != 'rb': raise Exception('mode is not \'rb\'')
+
+			if os.fstat(self.file.fileno()).st_size > 0:
+				self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+				self.view = memoryview(self.map)
+
+		# frame index: offset and record time of every frame, kept in a .pvi file next to the video
+		self.offsets = None
+		self.times = None
+
+		self.position = 0
+		self.index_file = open('{name}.pvi'.format(name=self.name), 'wb') if self.mode == 'wb' else None
+
+		# write buffer: length prefixes and payloads are queued separately and written with one writev
+		self.buffers = []
+		self.buffered = 0
+		self.buffer_size = buffer_size
+
+		# sync: 'close', ('frames', n) or ('seconds', t)
+		self.sync_policy = ('close', None) if sync == 'close' else tuple(sync)
+		if self.sync_policy[0] not in ('close', 'frames', 'seconds'): raise Exception('unknown sync policy: {sync}'.format(sync=sync))
+		self.frames = 0
+		self.synced_frames = 0
+		self.synced_time = time.monotonic()
+
+		# latency histograms in power of two microsecond buckets
+		self.latency = { 'write': [ 0 ] * 32, 'sync': [ 0 ] * 32 }
 
 	def __repr__(self):
 		return 'Pinto Video: {name}.pv'.format(name=self.name)
@@ -252,22 +901,189 @@ class PintoVideo:
 		if not data: raise StopIteration()
 		return data
 
+	def __len__(self):
+		if self.mode != 'rb': raise Exception('mode is not \'rb\'')
+
+		self.load()
+		return len(self.offsets)
+
+	def __getitem__(self, key):
+		self.load()
+
+		if isinstance(key, slice):
+			return [ self[i] for i in range(*key.indices(len(self.offsets))) ]
+
+		self.seek(range(len(self.offsets))[key])
+		return self.read()
+
 
 	def read(self):
 		if self.mode != 'rb': raise Exception('mode is not \'rb\'')
 
+		if self.view is not None:
+			if self.cursor + 4 > len(self.view): return None
+
+			size = int.from_bytes(self.view[self.cursor:self.cursor + 4], byteorder='big')
+			self.cursor += 4 + size
+			return self.view[self.cursor - size:self.cursor]
+
 		size = self.file.read(4)
 		if not size: return None
 
 		return None if not size else self.file.read(int.from_bytes(size, byteorder='big'))
 
-	def write(self, data):
+	def write(self, data, record_time=None):
 		if self.mode != 'wb': raise Exception('mode is not \'wb\'')
 
-		self.file.write(struct.pack('>I', len(data)) + data)
+		start = time.perf_counter()
+
+		# a rewritten frame keeps the record time of its source frame
+		self.index_file.write(struct.pack('>Qd', self.position, time.time() if record_time is None else record_time))
+
+		self.buffers.append(struct.pack('>I', len(data)))
+		if len(data) > 0: self.buffers.append(data)
+		self.buffered += 4 + len(data)
+		self.position += 4 + len(data)
+		self.frames += 1
+
+		if self.buffered >= self.buffer_size: self.flush()
+
+		policy, value = self.sync_policy
+		if policy == 'frames' and self.frames - self.synced_frames >= value: self.sync()
+		if policy == 'seconds' and time.monotonic() - self.synced_time >= value: self.sync()
+
+		PintoVideo.record(self.latency['write'], time.perf_counter() - start)
+
+	def flush(self):
+		buffers, self.buffers, self.buffered = self.buffers, [], 0
+
+		# writev may stop anywhere, continue from the first byte that was not written
+		i = 0
+		while i < len(buffers):
+			written = os.writev(self.file.fileno(), buffers[i:i + 1024])
+			while written > 0:
+				if written >= len(buffers[i]):
+					written -= len(buffers[i])
+					i += 1
+				else:
+					buffers[i] = memoryview(buffers[i])[written:]
+					written = 0
+
+	def sync(self):
+		start = time.perf_counter()
+
+		self.flush()
+		self.index_file.flush()
+		os.fsync(self.file.fileno())
+		os.fsync(self.index_file.fileno())
+
+		self.synced_frames = self.frames
+		self.synced_time = time.monotonic()
+
+		PintoVideo.record(self.latency['sync'], time.perf_counter() - start)
+
+	def histogram(self):
+		lines = []
+		for key, counts in self.latency.items():
+			buckets = [ '<{limit}us: {count}'.format(limit=1 << i, count=count) for i, count in enumerate(counts) if count > 0 ]
+			if buckets: lines.append('{key}: {buckets}'.format(key=key, buckets=', '.join(buckets)))
+		return '\n'.join(lines)
+
+	def seek(self, frame):
+		if self.mode != 'rb': raise Exception('mode is not \'rb\'')
+
+		self.load()
+		offset = self.offsets[frame] if frame < len(self.offsets) else os.fstat(self.file.fileno()).st_size
+
+		if self.view is not None:
+			self.cursor = offset
+		else:
+			self.file.seek(offset)
 
 	def close(self):
+		if self.mode == 'wb' and not self.file.closed: self.sync()
+
+		if self.view is not None:
+			# frames still referenced by the caller keep the mapping alive until they are released
+			try:
+				self.view.release()
+				self.map.close()
+			except BufferError:
+				pass
+
 		self.file.close()
+		if self.index_file: self.index_file.close()
+
+
+	def time(self, frame):
+		if self.mode != 'rb': raise Exception('mode is not \'rb\'')
+
+		self.load()
+		return self.times[frame]
+
+	def find(self, record_time):
+		if self.mode != 'rb': raise Exception('mode is not \'rb\'')
+
+		# the last frame recorded at or before record time, the first frame before any
+		self.load()
+		return max(0, bisect.bisect_right(self.times, record_time) - 1)
+
+	def load(self):
+		if self.mode != 'rb': raise Exception('mode is not \'rb\'')
+		if self.offsets is not None: return
+
+		position = self.file.tell()
+		size = os.fstat(self.file.fileno()).st_size
+
+		records = []
+		if os.path.exists('{name}.pvi'.format(name=self.name)):
+			with open('{name}.pvi'.format(name=self.name), 'rb') as index_file:
+				data = index_file.read()
+			records = list(struct.iter_unpack('>Qd', data[:len(data) // 16 * 16]))
+
+		# an index that does not end exactly at the end of the video is stale, fall back to scanning
+		end = 0
+		if records:
+			self.file.seek(records[-1][0])
+			length = self.file.read(4)
+			end = records[-1][0] + 4 + int.from_bytes(length, byteorder='big') if len(length) == 4 else -1
+
+		if end != size:
+			records = [ (offset, 0.0) for offset in PintoVideo.scan(self.file) ]
+
+		self.offsets = [ r[0] for r in records ]
+		self.times = [ r[1] for r in records ]
+		self.file.seek(position)
+
+
+	@staticmethod
+	def record(histogram, elapsed):
+		histogram[min(len(histogram) - 1, int(elapsed * 1000000).bit_length())] += 1
+
+	@staticmethod
+	def scan(file):
+		offsets = []
+
+		file.seek(0)
+		while True:
+			size = file.read(4)
+			if len(size) < 4: break
+
+			offsets.append(file.tell() - 4)
+			file.seek(int.from_bytes(size, byteorder='big'), os.SEEK_CUR)
+
+		return offsets
+
+	@staticmethod
+	def index(name):
+		# rebuild the .pvi of an existing video, record times are unknown and stored as 0
+		with open('{name}.pv'.format(name=name), 'rb') as file:
+			offsets = PintoVideo.scan(file)
+
+		with open('{name}.pvi'.format(name=name), 'wb') as index_file:
+			index_file.write(b''.join(struct.pack('>Qd', offset, 0.0) for offset in offsets))
+
+		return len(offsets)
 
 
 class PintoTimer:
@@ -294,16 +1110,17 @@ class PintoTimer:
 		return False
 
 	def expired(self):
-		return self.end_time == self.start_time or self.end_time < self.intermediate_time
+		# a zero target never expires
+		return self.end_time != self.start_time and self.end_time < self.intermediate_time
 
 
 class PintoConfiguration:
 
 	pinto_path = '.'
 
-	pv_path = lambda n: os.path.join(pinto_path, 'video', n)
-	pm_path = lambda n: os.path.join(pinto_path, 'meta', n)
-	ph_path = lambda n: os.path.join(pinto_path, 'hash', n)
+	pv_path = lambda n: os.path.join(PintoConfiguration.pinto_path, 'video', n)
+	pm_path = lambda n: os.path.join(PintoConfiguration.pinto_path, 'meta', n)
+	ph_path = lambda n: os.path.join(PintoConfiguration.pinto_path, 'hash', n)
 
 	path = { 'pv': pv_path, 'pm': pm_path, 'ph': ph_path }
 
@@ -312,7 +1129,9 @@ class PintoConfiguration:
 
 	@staticmethod
 	def load():
-		with open(os.path.join(pinto_path, 'config.txt'), 'r') as config:
+		data = {}
+
+		with open(os.path.join(PintoConfiguration.pinto_path, 'config.txt'), 'r') as config:
 			while True:
 				line = config.readline()
 				if not line: break
@@ -320,15 +1139,66 @@ class PintoConfiguration:
 				key, value = line.strip().split('=')
 				data[key] = value
 
-			if 'scale' in data: data['intensity'] = data['scale']
+		if 'scale' in data: data['intensity'] = data['scale']
 
-			order = { 'path': str, 'video_time': int, 'row': int, 'column': int, 'intensity': float }
+		order = { 'path': str, 'video_time': int, 'row': int, 'column': int, 'intensity': float }
 		return { k: v(data[k]) for k, v in order.items() }
 
 	@staticmethod
 	def save(data):
-		with open(os.path.join(pinto_path, 'config.txt'), 'w') as config:
-			config.write('\n'.join([ '{key}={value}'.format(key=k, value=v) for k, v in data.__dict__.items() ]))
+		with open(os.path.join(PintoConfiguration.pinto_path, 'config.txt'), 'w') as config:
+			config.write('\n'.join([ '{key}={value}'.format(key=k, value=v) for k, v in data.items() ]))
+
+
+def benchmark_pixelate(width=1280, height=720, row=10, column=10, intensity=12, frames=30, threads=(1, 2, 4)):
+	frame = numpy.random.randint(0, 256, (height, width, 3), dtype=numpy.uint8)
+	grid = PintoGrid.load(width, height, row, column)
+
+	# the block digests of a serial h pixelate are what every thread has to reproduce, any difference is a race
+	expected = [ PintoHash.new('sha1', h_pixelate(frame[block], intensity)).digest() for block in grid.slices ]
+
+	print('{cpus} cpus, {frames} frames of {blocks} blocks per thread'.format(cpus=os.cpu_count(), frames=frames, blocks=len(grid)))
+
+	base = None
+	for count in threads:
+		results = [ None ] * count
+
+		def work(t):
+			results[t] = [ [ PintoHash.new('sha1', pixelated).digest() for pixelated in h_pixelate_frame(frame, grid, intensity) ] for _ in range(frames) ]
+
+		workers = [ threading.Thread(target=work, args=(t,)) for t in range(count) ]
+		start = time.perf_counter()
+		for worker in workers: worker.start()
+		for worker in workers: worker.join()
+		elapsed = time.perf_counter() - start
+
+		if any(digests != expected for result in results for digests in result): error('h pixelate frame differs between {count} threads and serial'.format(count=count))
+
+		rate = count * frames / elapsed
+		base = base or rate
+		print('{count} threads: {rate:.1f} frames/s, {speedup:.2f}x, digests same as serial'.format(count=count, rate=rate, speedup=rate / base))
+
+def benchmark_hash(width=1280, height=720, row=10, column=10, intensity=12, seconds=1.0):
+	frame = numpy.random.randint(0, 256, (height, width, 3), dtype=numpy.uint8)
+	grid = PintoGrid.load(width, height, row, column)
+
+	# the inputs hashed for real: original blocks inside h pixelate, h pixelated blocks for the video hash
+	inputs = {
+		'block': [ numpy.ascontiguousarray(frame[block]) for block in grid.slices ],
+		'pixelated': [ h_pixelate(frame[block], intensity) for block in grid.slices ]
+	}
+
+	for key, blocks in inputs.items():
+		print('{key}: {count} blocks, {size} bytes each'.format(key=key, count=len(blocks), size=blocks[0].nbytes))
+
+		for algorithm in PintoHash.algorithms:
+			size, elapsed, start = 0, 0.0, time.perf_counter()
+			while elapsed < seconds:
+				for block in blocks: PintoHash.new(algorithm, block).digest()
+				size += sum(block.nbytes for block in blocks)
+				elapsed = time.perf_counter() - start
+
+			print('  {algorithm:>8}: {rate:8.1f} MB/s'.format(algorithm=algorithm, rate=size / elapsed / 1e6))
 
 
 if __name__ == '__main__':
@@ -345,20 +1215,34 @@ if __name__ == '__main__':
 		configuration = { 'path': os.path.dirname(os.path.abspath(__file__)), 'video_time': 60, 'row': 10, 'column': 10, 'intensity': 12 }
 
 		with open('config.txt', 'w') as config:
-			config.write('\n'.join([ '{key}={value}'.format(key=k, value=v) for k, v in configuration.__dict__.items() ]))
+			config.write('\n'.join([ '{key}={value}'.format(key=k, value=v) for k, v in configuration.items() ]))
 
 	elif len(sys.argv) == 3 and sys.argv[1] == 'configure':
 		if sys.argv[2] == 'list':
 			print(PintoConfiguration.load())
 		else:
-			key, value = line.strip().split('=')
+			key, _, value = sys.argv[2].partition('=')
 			if key in [ 'path', 'video_time', 'row', 'column', 'intensity' ] and len(value) > 0:
 				data = PintoConfiguration.load()
 				data[key] = value
 				PintoConfiguration.save(data)
 			else:
 				print('cannot configure it')
+
+	elif len(sys.argv) == 3 and sys.argv[1] == 'index':
+		count = PintoVideo.index(PintoConfiguration.pv_path(sys.argv[2]))
+		print('{name}: {count} frames indexed'.format(name=sys.argv[2], count=count))
+	elif len(sys.argv) in [2, 3] and sys.argv[1] == 'timestamp':
+		PintoTimestamp.serve(*map(int, sys.argv[2:]))
+	elif len(sys.argv) in [3, 8] and sys.argv[1] == 'benchmark' and sys.argv[2] == 'hash':
+		benchmark_hash(*map(int, sys.argv[3:7]), *map(float, sys.argv[7:]))
+	elif len(sys.argv) in [2, 7] and sys.argv[1] == 'benchmark':
+		benchmark_pixelate(*map(int, sys.argv[2:6]), *map(float, sys.argv[6:]))
 	else:
 		print('python3 {file} install'.format(file=sys.argv[0]))
 		print('python3 {file} configure list'.format(file=sys.argv[0]))
-		print('python3 {file} configure (key)=(value)'.format(file=sys.argv[0]))
\ No newline at end of file
+		print('python3 {file} configure (key)=(value)'.format(file=sys.argv[0]))
+		print('python3 {file} index (name)'.format(file=sys.argv[0]))
+		print('python3 {file} timestamp [(port)]'.format(file=sys.argv[0]))
+		print('python3 {file} benchmark [(width) (height) (row) (column) (intensity)]'.format(file=sys.argv[0]))
+		print('python3 {file} benchmark hash [(width) (height) (row) (column) (intensity)]'.format(file=sys.argv[0]))
\ No newline at end of file
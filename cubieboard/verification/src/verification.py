@@ -1,79 +1,324 @@
 import sys
+import re
+import math
+import time
+import multiprocessing
 import struct
 import numpy
 import cv2
 
-from pinto import PintoConfiguration, PintoMeta, PintoVideo, PintoHash, PintoBlock, error, h_pixelate
+from pinto import PintoConfiguration, PintoMeta, PintoVideo, PintoHash, PintoTimestamp, PintoGrid, PintoTrailer, error, parse_options, h_pixelate_frame
 
 
 
-def verify(ph_name, ppv_name):
-	unit = 16
+EOI = re.compile(b'\xFF\xD9')
+RST = re.compile(b'\xFF[\xD0-\xD7]')
+SOF = [ 0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF ]
 
-	ph = PintoHash.load(PintoConfiguration.ph_path(ph_name))
+def separate(data):
+	match = EOI.search(data)
+	if match is None: error('cannot find jpeg data')
+	index = match.start()
+
+	jpeg, pixelated = (data, None) if len(data) == index + 2 else (data[:index+2], data[index+2:])
+
+	return jpeg, PintoTrailer.unpack(pixelated or b'')
+
+def unpack(data, previous=None):
+	jpeg, trailer = separate(data)
+
+	# pinto blocks carry the h pixelated original block, hashed as it is. a delta needs the same block of the previous frame
+	blocks = {}
+	for index, data, delta in zip(trailer.indices, trailer.data, trailer.deltas):
+		block = PintoTrailer.decode(data, trailer.codec)
+		if delta:
+			if previous is None or index not in previous: error('pinto block {index} has no previous block'.format(index=index))
+			block = PintoTrailer.restore(block, previous[index])
+		blocks[index] = block
+
+	return jpeg, blocks
+
+def reference(ppv, frame, ppm):
+	# the blocks of the frame before, rebuilt from the keyframe before it. a keyframe needs none
+	if ppm.keyframe(frame): return None
+
+	first = frame - 1
+	while not ppm.keyframe(first): first -= 1
+
+	blocks = None
+	for i in range(first, frame):
+		_, blocks = unpack(ppv[i], blocks)
+
+	return blocks
+
+def header(jpeg):
+	# frame size, where a sequential frame stores its height, the mcu size, the restart interval and where the scan starts
+	size = { 'position': None, 'interval': 0 }
+
+	position = 2
+	while position + 4 <= len(jpeg):
+		marker, length = jpeg[position + 1], int.from_bytes(jpeg[position + 2:position + 4], byteorder='big')
+
+		if marker in SOF:
+			size['height'], size['width'] = struct.unpack('>HH', jpeg[position + 5:position + 9])
+			sampling = [ jpeg[position + 11 + 3 * i] for i in range(jpeg[position + 9]) ]
+			size['mcu width'], size['mcu height'] = 8 * max(f >> 4 for f in sampling), 8 * max(f & 0x0F for f in sampling)
+			if marker in [ 0xC0, 0xC1 ]: size['position'] = position + 5
+		elif marker == 0xDD:
+			size['interval'] = int.from_bytes(jpeg[position + 4:position + 6], byteorder='big')
+		elif marker == 0xDA:
+			size['scan'] = position + 2 + length
+			return size
+
+		position += 2 + length
+
+	error('cannot find frame header')
+
+def decode(jpeg, grid, blocks, size):
+	# only the rows down to the last block that is pixelated here are needed, none if every block is a pinto block
+	needed = [ i for i in range(len(grid)) if i not in blocks ]
+	if not needed: return None
+
+	# a sequential frame with restart markers can end after the interval holding the last needed mcu row,
+	# once that interval also ends an mcu row. one more mcu row keeps the chroma upsampling of the last needed row as in the full frame
+	bottom = int(grid.y[needed[-1] // grid.column + 1])
+	rows, columns = math.ceil(bottom / size['mcu height']) + 1, math.ceil(size['width'] / size['mcu width'])
+	if size['interval'] > 0:
+		while rows * columns % size['interval'] != 0: rows += 1
+
+	if size['position'] is not None and size['interval'] > 0 and rows * size['mcu height'] < size['height']:
+		intervals = rows * columns // size['interval']
+
+		# stuffed scan data has no 0xFF 0xD0-0xD7 other than restart markers
+		for i, marker in enumerate(RST.finditer(jpeg, size['scan'])):
+			if i + 1 < intervals: continue
+
+			jpeg = b''.join([ jpeg[:size['position']], struct.pack('>H', rows * size['mcu height']), jpeg[size['position'] + 2:marker.start()], b'\xFF\xD9' ])
+			break
+
+	return cv2.imdecode(numpy.frombuffer(jpeg, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
+
+def digest(jpeg, blocks, row, column, intensity, algorithm='sha1', pixelate_hash='sha256', unit=16):
+	size = header(jpeg)
+	grid = PintoGrid.load(size['width'], size['height'], row, column, unit)
+
+	frame = decode(jpeg, grid, blocks, size)
+	pixelated = h_pixelate_frame(frame, grid, intensity, [ i for i in range(len(grid)) if i not in blocks ], pixelate_hash) if frame is not None else None
+
+	return [ PintoHash.new(algorithm, blocks[i] if i in blocks else pixelated[i]).digest() for i in range(len(grid)) ]
+
+def frame_digests(arguments):
+	ppv_name, start, end, ppm, algorithm = arguments
+
+	frames, size = [], 0
+	with PintoVideo(PintoConfiguration.pv_path(ppv_name), 'rb', memory_map=True) as ppv:
+		blocks = reference(ppv, start, ppm)
+
+		ppv.seek(start)
+		for _ in range(start, end):
+			data = ppv.read()
+			jpeg, blocks = unpack(data, blocks)
+			frames.append(digest(jpeg, blocks, ppm.row, ppm.column, ppm.intensity, algorithm, ppm.pixelate_hash))
+			size += len(data)
+
+	return frames, size
+
+def frame_nodes(arguments):
+	frames, size = frame_digests(arguments)
+
+	pph = PintoHash(mode='merkle', algorithm=arguments[4])
+	for digests in frames:
+		for d in digests: pph.update(d)
+		pph.frame()
+
+	return pph.nodes, size
+
+def split(ppv_name, ph, ppm, start, end, workers):
+	# frame ranges of at most a second, enough of them to keep every worker busy
+	size = max(1, min(30, math.ceil((end - start) / (4 * workers))))
+
+	# with deltas a range only starts on a keyframe, so no worker rebuilds the blocks before its range
+	firsts = []
+	for i in range(start, end):
+		if not firsts or (i - firsts[-1] >= size and ppm.keyframe(i)): firsts.append(i)
+
+	return [ (ppv_name, i, j, ppm, ph.algorithm) for i, j in zip(firsts, firsts[1:] + [ end ]) ]
+
+def run(function, ranges, workers):
+	# results come back in range order, from the pool or from this process
+	if workers > 1:
+		with multiprocessing.Pool(workers) as pool:
+			yield from pool.imap(function, ranges)
+	else:
+		yield from map(function, ranges)
+
+
+class Progress:
+
+	def __init__(self, total, interval=1.0):
+		self.total = total
+		self.interval = interval
+		self.frames = 0
+		self.size = 0
+		self.start = self.last = time.perf_counter()
+
+	def update(self, frames, size):
+		self.frames += frames
+		self.size += size
 
-	pph = PintoHash()
+		if time.perf_counter() - self.last >= self.interval: self.show()
+
+	def show(self):
+		self.last = time.perf_counter()
+		elapsed = max(self.last - self.start, 1e-9)
+
+		# progress goes to stderr, stdout only gets the result
+		sys.stderr.write('\r{frames}/{total} frames, {fps:.1f} fps, {rate:.2f} MB/s'.format(frames=self.frames, total=self.total, fps=self.frames / elapsed, rate=self.size / elapsed / 1e6))
+		sys.stderr.flush()
+
+	def end(self):
+		self.show()
+		sys.stderr.write('\n')
+
+
+def mismatched(ph, frame, digests):
+	# blocks whose digest does not start with the fingerprint recorded for them, none without fingerprints
+	if frame >= len(ph.fingerprints): return []
+
+	size = 2 * ph.fingerprint
+	return [ i for i, d in enumerate(digests) if d[:ph.fingerprint].hex() != ph.fingerprints[frame][i * size:(i + 1) * size] ]
+
+def diverged(progress, first, last, blocks=()):
+	progress.end()
+
+	frames = 'frame {first}'.format(first=first) if first == last else 'frames {first} to {last}'.format(first=first, last=last)
+	if blocks: frames += ', block {blocks}'.format(blocks=', '.join(map(str, blocks)))
+	print('not same: {frames}'.format(frames=frames))
+
+def verify(ph_name, ppv_name, workers=1, start=None, end=None):
+	ph = PintoHash.load(PintoConfiguration.ph_path(ph_name))
 	ppm = PintoMeta.load(PintoConfiguration.pm_path(ppv_name))
 
+	# dropped frames are gaps in the recording itself, the hash can only vouch for the frames around them
+	if ppm.dropped:
+		print('{count} frames dropped while recording, before frame {frames}'.format(count=len(ppm.dropped), frames=', '.join(sorted(set(str(frame) for frame, _ in ppm.dropped), key=int))))
+
+	# a batched stamp signs the batch root, the digest has to be one of its leaves
+	if ph.batch_root and PintoTimestamp.prove(ph.digest, ph.proof) != ph.batch_root:
+		print('not same: digest is not in its timestamped batch')
+		return
+
+	if ph.mode == 'merkle':
+		verify_merkle(ph, ppv_name, ppm, workers, start, end)
+		return
+
+	if start is not None or end is not None: error('a range needs a merkle hash')
+
+	pph = PintoHash(algorithm=ph.algorithm, checkpoint=ph.checkpoint)
+
 	with PintoVideo(PintoConfiguration.pv_path(ppv_name), 'rb') as ppv:
-		for data in ppv:
-			index = data.find(b'\xFF\xD9')
-			if index < 0: error('cannot find jpeg data')
-
-			jpeg, pixelated = (data, None) if len(data[index+2:]) == 0 else (data[:index+2], data[index+2:])
-
-			frame = cv2.imdecode(numpy.fromstring(jpeg, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
-			width, height = frame.shape[1::-1]
-
-			if pixelated:
-				size, pixelated = struct.unpack('>H', pixelated[:2])[0], pixelated[2:]
-				pb['count'] = size // 2
-
-				indices, encoded = pixelated[:size], pixelated[size:]
-				while len(indices) > 0:
-					pb['indices'].append(struct.unpack('>H', indices[:2])[0])
-					indices = indices[2:]
-				
-				while len(encoded) > 0:
-					size, encoded = struct.unpack('>I', encoded[:4])[0], encoded[4:]
-					data, encoded = encoded[:size], encoded[size:]
-					pb['encoded data'].append(data)
-
-				if pb['count'] != len(pb['indices']):  error('count and number of indices is not same')
-				if pb['count'] != len(pb['encoded data']): error('count and number of encoded data is not same')
-
-				for i in range(pb['count']):
-					ri, ci = pb['indices'][i] // pm.column, pb['indices'][i] % pm.column
-					sx = PintoBlock.position(ci, pm.column, width, unit)
-					ex = PintoBlock.position(ci + 1, pm.column, width, unit)
-					sy = PintoBlock.position(ri, pm.row, height, unit)
-					ey = PintoBlock.position(ri + 1, pm.row, height, unit)
-					frame[sy:ey, sx:ex] = cv2.imdecode(numpy.fromstring(pb['encoded data'][i], dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
-			
-			i = 0
-			x1, y1, x2, y2 = 0, 0, 0, 0
-			for r in range(ppm.row):
-				x1, y1, x2, y2 = 0, y2, 0, PintoBlock.position(r + 1, ppm.row, height, unit)
-				for c in range(ppm.column):
-					x1, x2 = x2, PintoBlock.position(c + 1, ppm.column, width, unit)
-					if i in pb['indices']:
-						pph.update(hashlib.sha1(frame[y1:y2, x1:x2]).digest())
-					else:
-						pph.update(hashlib.sha1(h_pixelate(frame[y1:y2, x1:x2], ppm.intensity)).digest())
-					i += 1
+		count = len(ppv)
+
+	# block digests are computed over the pool, but folded into the chain here, in frame order
+	ranges = split(ppv_name, ph, ppm, 0, count, workers)
+
+	progress = Progress(count)
+	for arguments, (frames, size) in zip(ranges, run(frame_digests, ranges, workers)):
+		progress.update(len(frames), size)
+
+		# every frame is checked against the fingerprints and checkpoints recorded with it, the first divergence ends it
+		for i, digests in enumerate(frames, arguments[1]):
+			for d in digests: pph.update(d)
+			pph.frame()
+
+			blocks = mismatched(ph, i, digests)
+			if blocks: return diverged(progress, i, i, blocks)
 
+			if ph.checkpoint > 0 and pph.frames % ph.checkpoint == 0:
+				k = len(pph.checkpoints) - 1
+				if k >= len(ph.checkpoints) or pph.checkpoints[k] != ph.checkpoints[k]: return diverged(progress, i - ph.checkpoint + 1, i)
+
+	progress.end()
 
 	if ph.digest == pph.digest:
 		print('same')
 	else:
 		print('not same')
 
+def verify_merkle(ph, ppv_name, ppm, workers, start, end):
+	# the stored frame nodes have to lead to the timestamped root before any of them is trusted
+	if ph.root() != ph.digest:
+		print('not same: hash tree does not match its root')
+		return
+
+	with PintoVideo(PintoConfiguration.pv_path(ppv_name), 'rb') as ppv:
+		count = len(ppv)
+
+	if count != len(ph.nodes):
+		print('not same: {count} frames, {nodes} in hash'.format(count=count, nodes=len(ph.nodes)))
+		return
+
+	# frames are independent, only the requested ones are rehashed
+	start, end, _ = slice(start, end).indices(count)
+	ranges = split(ppv_name, ph, ppm, start, end, workers)
+
+	progress = Progress(end - start)
+	for arguments, (nodes, size) in zip(ranges, run(frame_nodes, ranges, workers)):
+		progress.update(len(nodes), size)
+
+		for i, node in enumerate(nodes, arguments[1]):
+			if node == ph.nodes[i]: continue
+
+			# only the diverging frame is hashed again, for its blocks
+			with PintoVideo(PintoConfiguration.pv_path(ppv_name), 'rb') as ppv:
+				jpeg, blocks = unpack(ppv[i], reference(ppv, i, ppm))
+				blocks = mismatched(ph, i, digest(jpeg, blocks, ppm.row, ppm.column, ppm.intensity, ph.algorithm, ppm.pixelate_hash))
+			return diverged(progress, i, i, blocks)
+
+	progress.end()
+	print('same')
+
+
+def benchmark(ppv_name, unit=16):
+	ppm = PintoMeta.load(PintoConfiguration.pm_path(ppv_name))
+
+	frames, partial, full, identical = 0, 0.0, 0.0, True
+	with PintoVideo(PintoConfiguration.pv_path(ppv_name), 'rb', memory_map=True) as ppv:
+		blocks = None
+		for data in ppv:
+			jpeg, blocks = unpack(data, blocks)
+
+			start = time.perf_counter()
+			size = header(jpeg)
+			grid = PintoGrid.load(size['width'], size['height'], ppm.row, ppm.column, unit)
+			frame = decode(jpeg, grid, blocks, size)
+			partial += time.perf_counter() - start
+
+			start = time.perf_counter()
+			reference = cv2.imdecode(numpy.frombuffer(jpeg, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
+			full += time.perf_counter() - start
+
+			# every row above the extra mcu row can be hashed, it has to match the full decode
+			if frame is not None:
+				rows = len(frame) if len(frame) == len(reference) else len(frame) - size['mcu height']
+				identical = identical and numpy.array_equal(frame[:rows], reference[:rows])
+			frames += 1
+
+	for key, elapsed in [ ('full', full), ('partial', partial) ]:
+		print('{key}: {frames} frames in {elapsed:.3f}s, {fps:.2f} fps'.format(key=key, frames=frames, elapsed=elapsed, fps=frames / elapsed if elapsed > 0 else 0))
+	print('partial decode is {result} the full decode'.format(result='identical to' if identical else 'different from'))
+
 
 
 if __name__ == '__main__':
-	if len(sys.argv) == 3:
-		ph_name, pixelated_name = sys.argv[1:]
+	if len(sys.argv) == 3 and sys.argv[1] == 'benchmark':
+		benchmark(sys.argv[2])
+	elif len(sys.argv) >= 3:
+		ph_name, pixelated_name = sys.argv[1:3]
+		options = parse_options(sys.argv[3:], [ '--workers', '--start', '--end' ])
 
-		verify(ph_name, pixelated_name)
+		start, end = options.get('--start'), options.get('--end')
+		verify(ph_name, pixelated_name, workers=int(options.get('--workers', 1)), start=start and int(start), end=end and int(end))
 	else:
-		print('python3 {file} (name) (pixelated name)'.format(file=sys.argv[0]))
\ No newline at end of file
+		print('python3 {file} (name) (pixelated name) [--workers (count)] [--start (frame)] [--end (frame)]'.format(file=sys.argv[0]))
+		print('python3 {file} benchmark (pixelated name)'.format(file=sys.argv[0]))
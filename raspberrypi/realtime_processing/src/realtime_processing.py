@@ -1,15 +1,38 @@
+import sys
 import os
 import time
 import threading
+import multiprocessing
+import multiprocessing.pool
+import collections
+import numpy
+import cv2
 
-from pinto import PintoConfiguration, PintoMeta, PintoHash, PintoBlock, PintoTimer, AbstractVideoRecorder, time2str, error, h_pixelate
+from queue import Queue
+from pinto import PintoConfiguration, PintoMeta, PintoVideo, PintoHash, PintoTimestamp, PintoGrid, PintoTimer, AbstractVideoRecorder, time2str, error, parse_options, h_pixelate_frame
 
 
 
+def digest(data, row, column, intensity, algorithm, pixelate_hash):
+	start = time.perf_counter()
+
+	frame = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
+	width, height = frame.shape[1::-1]
+
+	grid = PintoGrid.load(width, height, row, column, 16)
+	digests = [ PintoHash.new(algorithm, pixelated).digest() for pixelated in h_pixelate_frame(frame, grid, intensity, algorithm=pixelate_hash) ]
+
+	# only the decode and hash time of this frame, not the time it waited for a worker
+	return digests, time.perf_counter() - start
+
+
 class PintoVideoRecorder(AbstractVideoRecorder):
 
-	def __init__(self, camera, path, meta):
-		super().__init__()
+	# processes by default: decode, resize and the block hashes release the gil, the python between them does not. threads save pickling each frame, 'benchmark' shows which wins on a board
+	pools = { 'process': multiprocessing.Pool, 'thread': multiprocessing.pool.ThreadPool }
+
+	def __init__(self, camera, path, meta, buffer_size=1 << 20, sync='close', workers=None, window=None, hash_mode='chain', hash_algorithm='sha1', timestamp=None, checkpoint=1, fingerprint=0, pool='process'):
+		super().__init__(camera)
 
 		self.pv_path, self.pm_path, self.ph_path = path
 
@@ -17,74 +40,200 @@ class PintoVideoRecorder(AbstractVideoRecorder):
 		self.row = meta.row
 		self.column = meta.column
 		self.intensity = meta.intensity
+		self.pixelate_hash = meta.pixelate_hash
+
+		self.buffer_size = buffer_size
+		self.sync = sync
+		self.hash_mode = hash_mode
+		self.hash_algorithm = hash_algorithm
+		self.checkpoint = checkpoint
+		self.fingerprint = fingerprint
+
+		# frames are hashed in worker processes, at most window frames in flight
+		self.workers = workers or os.cpu_count()
+		self.window = window or 2 * self.workers
+		self.pool = PintoVideoRecorder.pools[pool](self.workers)
+		self.pending = collections.deque()
+
+		# segments are stamped in the background over one connection, end never waits for the server
+		self.timestamp = timestamp or PintoTimestamp()
 
 		self.lock = threading.Lock()
 
+		# a finished segment is folded, closed and saved here, the camera keeps writing the next one meanwhile
+		self.closing = Queue()
+		self.closer = threading.Thread(target=self.finish)
+		self.closer.start()
+
 		self.pv = None
 		self.ph = None
 		self.video_file = ''
 		self.frame_count = 0
+		self.dropped = []
+		self.late = 0
 
 
 	def begin(self, video_file):
-		self.pv = PintoVideo(self.pv_path(video_file), 'wb')
-		self.ph = PintoHash()
-		self.video_file = video_file
-		self.frame_count = 0
+		pv = PintoVideo(self.pv_path(video_file), 'wb', buffer_size=self.buffer_size, sync=self.sync)
+		ph = PintoHash(mode=self.hash_mode, algorithm=self.hash_algorithm, checkpoint=self.checkpoint, fingerprint=self.fingerprint)
+
+		# frames dropped since the last segment ended stay counted in this one
+		with self.lock:
+			self.pv, self.ph, self.video_file = pv, ph, video_file
 
 
 	def write(self, data):
 		with self.lock:
-			if self.pv:
-				self.pv.write(data)
+			# between two segments there is nothing to write to, the frame goes to the .pm of the next one as dropped
+			if self.pv is None:
+				self.dropped.append((self.frame_count, time.time()))
+				return
 
-				frame = cv2.imdecode(numpy.fromstring(data, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
-				width, height = frame.shape[1::-1]
+			self.late += self.fold(self.pending, self.ph)
 
-				x1, y1, x2, y2 = 0, 0, 0, 0
-				for r in range(self.row):
-					x1, y1, x2, y2 = 0, y2, 0, PintoBlock.position(r + 1, self.row, height, 16)
-					for c in range(self.column):
-						x1, x2 = x2, PintoBlock.position(c + 1, self.column, width, 16)
-						self.ph.update(hashlib.sha1(h_pixelate(frame[y1:y2, x1:x2], self.intensity)).digest())
+			# a frame is dropped from both the video and the hash, so the two stay consistent. where it was goes to the .pm
+			if len(self.pending) >= self.window:
+				self.dropped.append((self.frame_count, time.time()))
+				return
 
-				self.frame_count += 1
+			self.pv.write(data)
+			self.pending.append(self.pool.apply_async(digest, (data, self.row, self.column, self.intensity, self.hash_algorithm, self.pixelate_hash)))
 
+			self.frame_count += 1
 
-	def end(self):
-		with self.lock:
-			self.pv.close()
 
-			pm = PintoMeta(self.video_time, self.row, self.column, self.intensity, self.frame_count)
-			PintoMeta.save(self.pm_path(self.video_file), pm)
+	def fold(self, pending, ph, wait=False):
+		late = 0
+
+		# digests are folded in frame order, only from the oldest frame onwards
+		while pending and (wait or pending[0].ready()):
+			digests, elapsed = pending.popleft().get()
+
+			for d in digests: ph.update(d)
+			ph.frame()
 
-			PintoHash.save(self.ph_path(self.video_file), self.ph)
+			# late: hashing alone took longer than a frame, waiting in the window is not counted
+			if elapsed > 1 / self.framerate: late += 1
+
+		return late
+
+
+	def end(self):
+		# only the segment is swapped out under the lock, write never waits for its digests, close or save
+		with self.lock:
+			segment = (self.pv, self.ph, self.pending, self.video_file, self.frame_count, self.dropped, self.late)
 
 			self.pv = None
 			self.ph = None
+			self.pending = collections.deque()
 			self.video_file = ''
 			self.frame_count = 0
+			self.dropped = []
+			self.late = 0
 
-def record(camera, path, meta):
-	recorder = PintoVideoRecorder(camera, path, meta)
+		self.closing.put(segment)
+
+	def finish(self):
+		while True:
+			segment = self.closing.get()
+			if segment is None: break
+
+			pv, ph, pending, video_file, frame_count, dropped, late = segment
+			late += self.fold(pending, ph, True)
+
+			pv.close()
+			print('{video_file}: {frame_count} frames, {dropped} dropped, {late} late\n{histogram}'.format(video_file=video_file, frame_count=frame_count, dropped=len(dropped), late=late, histogram=pv.histogram()))
+
+			pm = PintoMeta(self.video_time, self.row, self.column, self.intensity, frame_count, self.pixelate_hash, dropped)
+			PintoMeta.save(self.pm_path(video_file), pm)
+
+			PintoHash.save(self.ph_path(video_file), ph, self.timestamp)
+
+
+	def close(self):
+		# the last segments are saved before their digests' pool and the timestamp go away
+		self.closing.put(None)
+		self.closer.join()
+
+		self.pool.close()
+		self.pool.join()
+		self.timestamp.close()
+
+def record(camera, path, meta, hash_mode='chain', hash_algorithm='sha1', batch_time=None, checkpoint=1, fingerprint=0, pool='process', buffer_size=1 << 20, sync='close'):
+	# with a batch time, the segments finished within it share one stamp on the root of their digests
+	timestamp = None if batch_time is None else PintoTimestamp(aggregate=True, linger=batch_time)
+
+	recorder = PintoVideoRecorder(camera, path, meta, buffer_size=buffer_size, sync=sync, hash_mode=hash_mode, hash_algorithm=hash_algorithm, timestamp=timestamp, checkpoint=checkpoint, fingerprint=fingerprint, pool=pool)
 	recorder.start()
 
+	# a new segment every video time until interrupted
+	recorder.record(time2str(time.time()))
+
 	try:
-		for updated in Timer(0, meta.video_time, time.time):
+		for updated in PintoTimer(0, meta.video_time, time.time):
 			if updated: recorder.record(time2str(time.time()))
+			else: time.sleep(0.1)
 	except KeyboardInterrupt as e:
 		pass
 
 	recorder.record(None)
+	recorder.join()
+	recorder.close()
+
+
+def benchmark(camera, row=10, column=10, intensity=12, frames=60, workers=(1, 2, 4)):
+	image = numpy.random.randint(0, 256, (camera['height'], camera['width'], 3), dtype=numpy.uint8)
+	jpegs = [ cv2.imencode('.jpg', numpy.roll(image, i, axis=1))[1].tobytes() for i in range(frames) ]
+
+	# the recorder's own work per frame, serially, is what every pool has to reproduce
+	expected = [ digest(jpeg, row, column, intensity, 'sha1', 'sha256')[0] for jpeg in jpegs ]
+
+	print('{cpus} cpus, {frames} frames of {width}x{height}'.format(cpus=os.cpu_count(), frames=frames, width=camera['width'], height=camera['height']))
+	for kind, Pool in PintoVideoRecorder.pools.items():
+		for count in workers:
+			with Pool(count) as pool:
+				start = time.perf_counter()
+				results = [ pool.apply_async(digest, (jpeg, row, column, intensity, 'sha1', 'sha256')) for jpeg in jpegs ]
+				digests = [ result.get()[0] for result in results ]
+				elapsed = time.perf_counter() - start
+
+			if digests != expected: error('digests of {count} {kind} workers differ from serial'.format(count=count, kind=kind))
+			print('{kind:>7} x {count}: {rate:.1f} frames/s'.format(kind=kind, count=count, rate=frames / elapsed))
 
 
 
 if __name__ == '__main__':
-	if len(sys.argv) == 5:
+	if len(sys.argv) in [2, 5] and sys.argv[1] == 'benchmark':
+		benchmark(PintoConfiguration.camera, *map(int, sys.argv[2:4]), *map(float, sys.argv[4:]))
+	elif len(sys.argv) >= 5:
 		camera = PintoConfiguration.camera
 		path = list(PintoConfiguration.path.values())
-		meta = PintoMeta(*sys.argv[1:], 0)
+		options = parse_options(sys.argv[5:], [ '--mode', '--hash', '--pixelate-hash', '--batch-time', '--checkpoint', '--fingerprint', '--pool', '--buffer-size', '--sync' ])
+
+		hash_mode, hash_algorithm, pixelate_hash = options.get('--mode', 'chain'), options.get('--hash', 'sha1'), options.get('--pixelate-hash', 'sha256')
+		meta = PintoMeta(*sys.argv[1:5], 0, pixelate_hash)
+
+		if hash_mode not in PintoHash.modes: error('unknown hash mode: {mode}'.format(mode=hash_mode))
+		for algorithm in [ hash_algorithm, pixelate_hash ]:
+			if algorithm not in PintoHash.algorithms: error('unknown hash algorithm: {algorithm}'.format(algorithm=algorithm))
+
+		batch_time = options.get('--batch-time')
+		checkpoint, fingerprint = int(options.get('--checkpoint', 1)), int(options.get('--fingerprint', 0))
+
+		pool = options.get('--pool', 'process')
+		if pool not in PintoVideoRecorder.pools: error('unknown pool: {pool}'.format(pool=pool))
+
+		buffer_size = int(options.get('--buffer-size', 1 << 20))
+		if buffer_size < 0: error('buffer size must not be negative: {buffer_size}'.format(buffer_size=buffer_size))
+
+		# close, frames:(count) or seconds:(time)
+		policy, _, value = options.get('--sync', 'close').partition(':')
+		if policy == 'close' and not value: sync = 'close'
+		elif policy == 'frames' and value.isdigit() and int(value) > 0: sync = (policy, int(value))
+		elif policy == 'seconds' and value.replace('.', '', 1).isdigit() and float(value) > 0: sync = (policy, float(value))
+		else: error('unknown sync policy: {sync} (expected close, frames:(count) or seconds:(time))'.format(sync=options['--sync']))
 
-		record(camera, path, meta)
+		record(camera, path, meta, hash_mode, hash_algorithm, batch_time and float(batch_time), checkpoint, fingerprint, pool, buffer_size, sync)
 	else:
-		print('python3 {file} (video time) (row) (column) (intensity)'.format(file=sys.argv[0]))
\ No newline at end of file
+		print('python3 {file} (video time) (row) (column) (intensity) [--mode (chain | merkle)] [--hash (algorithm)] [--pixelate-hash (algorithm)] [--batch-time (seconds)] [--checkpoint (frames)] [--fingerprint (bytes)] [--pool (process | thread)] [--buffer-size (bytes)] [--sync (close | frames:(count) | seconds:(time))]'.format(file=sys.argv[0]))
+		print('python3 {file} benchmark [(row) (column) (intensity)]'.format(file=sys.argv[0]))
\ No newline at end of file